@@ -0,0 +1,50 @@
+''' In-process caches for read only data of api '''
+import copy
+import threading
+from collections import OrderedDict
+from django.conf import settings
+
+
+class LayoutGridCache:
+    '''
+    LRU cache of layout grids keyed by layout id, the version of the layout catalog and the
+    kind of grid (the full grid or its compact form). The version is the CatalogVersion stamp
+    of the layouts, read from the database by the caller, so a layout or seat saved by any
+    process makes the older entries of every process unreachable. Callers always get a deep
+    copy of the cached grid.
+    '''
+
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, layout_id, builder, version, kind='grid'):
+        ''' Returns the grid of the layout at the version, building it with builder() on a miss '''
+        key = (layout_id, version, kind)
+        with self._lock:
+            grid = self._entries.get(key)
+            if grid is not None:
+                self._entries.move_to_end(key)
+                return copy.deepcopy(grid)
+        grid = builder()
+        with self._lock:
+            self._entries[key] = grid
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return copy.deepcopy(grid)
+
+    def invalidate(self, *layout_ids):
+        ''' Drops the grids of the layouts held by this process, the version bump covers the others '''
+        with self._lock:
+            for key in [key for key in self._entries if key[0] in layout_ids]:
+                del self._entries[key]
+
+    def clear(self):
+        ''' Drops every cached grid '''
+        with self._lock:
+            self._entries.clear()
+
+
+layout_grid_cache = LayoutGridCache(getattr(settings, 'LAYOUT_GRID_CACHE_SIZE', 256))
@@ -8,4 +8,10 @@ class RouteValueException(Exception):
     ''' Raised when source or destination of route is empty '''
 
 class EmptyValueException(Exception):
-    ''' Raised when a value is empty or blank '''
\ No newline at end of file
+    ''' Raised when a value is empty or blank '''
+
+class ScheduleRecurrenceException(Exception):
+    ''' Raised when a recurring schedule spec is invalid '''
+
+class PaginationException(Exception):
+    ''' Raised when the cursor or the limit of a paginated request is invalid '''
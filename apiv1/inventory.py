@@ -0,0 +1,170 @@
+''' Upkeep of the per trip seat counts and seat map versions kept in TripInventory '''
+import functools
+import operator
+import time
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Case, Count, F, IntegerField, OuterRef, Q, Subquery, Value, When
+from django.utils import timezone
+from .models import Booking, Seat, ScheduledVehicle, TripInventory, SeatChange
+from .utils import SEAT_STATE_CODES
+
+# bookings that are seat holds, every other booking counts as booked
+HOLD = Q(state='locked', expires_on__isnull=False)
+# trips whose counts release_holds updates with one statement
+RELEASE_BATCH_SIZE = 100
+
+
+def counted_inventory(trip_id, schedule_id):
+    ''' Returns an unsaved inventory of the trip on the schedule counted from its seats and bookings '''
+    layout_id = ScheduledVehicle.objects.filter(id=trip_id).values_list(
+        'vehicle__vehicle_type__layout_id', flat=True).first()
+    counts = Booking.objects.filter(trip_id=trip_id, schedule_id=schedule_id).aggregate(
+        locked=Count('id', filter=HOLD), booked=Count('id', filter=~HOLD))
+    return TripInventory(trip_id=trip_id, schedule_id=schedule_id,
+                         total=Seat.objects.filter(layout_id=layout_id).count(), **counts)
+
+
+def adjust_inventory(trip_id, schedule_id, booked=0, locked=0, seats=None):
+    '''
+    Adds to the booked and locked counts of the trip on the schedule, to be called inside the
+    transaction of the booking write it accounts for. The first write to a trip counts its
+    inventory from scratch, the write itself included. seats maps the ids of the seats written
+    to their new state, the changes get logged under the bumped version of the inventory.
+    '''
+    if trip_id is None or schedule_id is None or not (booked or locked or seats):
+        return
+    inventory = TripInventory.objects.filter(trip_id=trip_id, schedule_id=schedule_id)
+    changes = {'booked': F('booked') + booked, 'locked': F('locked') + locked, 'version': F('version') + 1}
+    if not inventory.update(**changes):
+        try:
+            with transaction.atomic():
+                counted = counted_inventory(trip_id, schedule_id)
+                counted.version = 1
+                counted.save()
+        except IntegrityError:
+            # counted by a concurrent write that could not see this one
+            inventory.update(**changes)
+    if seats:
+        version = inventory.values_list('version', flat=True).get()
+        SeatChange.objects.bulk_create([
+            SeatChange(trip_id=trip_id, schedule_id=schedule_id, seat_id=seat_id, state=state, version=version)
+            for seat_id, state in seats.items()
+        ])
+
+
+def release_holds(holds):
+    '''
+    Deletes the given holds and takes them off the locked counts, returns how many went. The
+    holds are locked before they are read, so that of two releases racing over the same hold
+    only the first counts it. The counts of up to RELEASE_BATCH_SIZE trips are updated
+    together, so sweeping the expired holds of many trips takes a handful of queries.
+    '''
+    with transaction.atomic(savepoint=False):
+        released = list(holds.select_for_update().values_list('id', 'trip_id', 'schedule_id', 'seat_id'))
+        if not released:
+            return 0
+        Booking.objects.filter(id__in=[hold_id for hold_id, _, _, _ in released]).delete()
+        freed = {}
+        for _, trip_id, schedule_id, seat_id in released:
+            if trip_id is not None and schedule_id is not None:
+                freed.setdefault((trip_id, schedule_id), {})[seat_id] = 'available'
+        pairs = list(freed)
+        for start in range(0, len(pairs), RELEASE_BATCH_SIZE):
+            batch = pairs[start:start + RELEASE_BATCH_SIZE]
+            inventories = TripInventory.objects.filter(functools.reduce(operator.or_, (
+                Q(trip_id=trip_id, schedule_id=schedule_id) for trip_id, schedule_id in batch)))
+            inventories.update(version=F('version') + 1, locked=F('locked') - Case(*[
+                When(trip_id=trip_id, schedule_id=schedule_id, then=Value(len(freed[(trip_id, schedule_id)])))
+                for trip_id, schedule_id in batch
+            ], output_field=IntegerField()))
+            versions = {(trip_id, schedule_id): version for trip_id, schedule_id, version
+                        in inventories.values_list('trip_id', 'schedule_id', 'version')}
+            SeatChange.objects.bulk_create([
+                SeatChange(trip_id=trip_id, schedule_id=schedule_id, seat_id=seat_id, state=state, version=version)
+                for (trip_id, schedule_id), version in versions.items()
+                for seat_id, state in freed[(trip_id, schedule_id)].items()
+            ])
+            for trip_id, schedule_id in set(batch) - set(versions):
+                # never counted, counting it now leaves the released holds out
+                adjust_inventory(trip_id, schedule_id, seats=freed[(trip_id, schedule_id)])
+    return len(released)
+
+
+def prune_seat_changes():
+    ''' Deletes the seat changes more than SEAT_CHANGE_VERSIONS versions behind their trip, returns how many went '''
+    current = TripInventory.objects.filter(
+        trip_id=OuterRef('trip_id'), schedule_id=OuterRef('schedule_id')).values('version')
+    pruned, _ = SeatChange.objects.filter(
+        version__lte=Subquery(current, output_field=IntegerField()) - settings.SEAT_CHANGE_VERSIONS).delete()
+    return pruned
+
+
+def get_inventory(trip_id, schedule_id):
+    ''' Returns the inventory of the trip on the schedule, counting and saving it when there is none yet '''
+    try:
+        return TripInventory.objects.get(trip_id=trip_id, schedule_id=schedule_id)
+    except TripInventory.DoesNotExist:
+        pass
+    inventory = counted_inventory(trip_id, schedule_id)
+    try:
+        with transaction.atomic():
+            inventory.save()
+    except IntegrityError:
+        return TripInventory.objects.get(trip_id=trip_id, schedule_id=schedule_id)
+    return inventory
+
+
+def inventory_version(trip_id, schedule_id):
+    ''' Returns the seat map version of the trip on the schedule, 0 before its first booking '''
+    return TripInventory.objects.filter(trip_id=trip_id, schedule_id=schedule_id).values_list(
+        'version', flat=True).first() or 0
+
+
+def current_version(trip_id, schedule_id):
+    '''
+    Returns the seat map version of the trip on the schedule after releasing its expired holds,
+    so that a hold running out counts as a change without waiting for the sweeper
+    '''
+    release_holds(Booking.objects.filter(HOLD, trip_id=trip_id, schedule_id=schedule_id,
+                                         expires_on__lte=timezone.now()))
+    return inventory_version(trip_id, schedule_id)
+
+
+def wait_for_change(trip_id, schedule_id, since, timeout):
+    '''
+    Returns the seat map version of the trip on the schedule once it moves past since or the
+    timeout (capped at SEAT_MAP_MAX_WAIT seconds) runs out, checking every SEAT_MAP_POLL_SECONDS.
+    This keeps a worker busy for the whole wait.
+    '''
+    deadline = time.monotonic() + min(timeout, settings.SEAT_MAP_MAX_WAIT)
+    version = current_version(trip_id, schedule_id)
+    while version == since and time.monotonic() < deadline:
+        time.sleep(max(min(settings.SEAT_MAP_POLL_SECONDS, deadline - time.monotonic()), 0))
+        version = current_version(trip_id, schedule_id)
+    return version
+
+
+def seat_changes(trip_id, schedule_id, since, compact=False):
+    '''
+    Returns the latest state of every seat of the trip changed after the since version, by
+    position. Holds that have expired show as available, as they do on the full seat map. The
+    compact form gives [index, state code] pairs, index being the place of the seat in the
+    states string of the compact seat map.
+    '''
+    changes = SeatChange.objects.filter(trip_id=trip_id, schedule_id=schedule_id, version__gt=since).order_by(
+        'version', 'id').values_list('seat_id', 'seat__row', 'seat__col', 'state')
+    latest = {(row, col): (seat_id, state) for seat_id, row, col, state in changes}
+    held = [seat_id for seat_id, state in latest.values() if state == 'locked']
+    expired = set(Booking.objects.filter(
+        trip_id=trip_id, schedule_id=schedule_id, seat_id__in=held, state='locked', expires_on__lte=timezone.now()
+    ).values_list('seat_id', flat=True)) if held else set()
+    if compact:
+        # same seats and order as compact_seat_states
+        seats = Seat.objects.filter(layout__vehicletype__vehicle__scheduledvehicle=trip_id).order_by(
+            'row', 'col').values_list('id', flat=True)
+        index = {seat_id: position for position, seat_id in enumerate(seats)}
+        return [[index[seat_id], SEAT_STATE_CODES['available' if seat_id in expired else state]]
+                for _, (seat_id, state) in sorted(latest.items()) if seat_id in index]
+    return [{'row': row, 'col': col, 'state': 'available' if seat_id in expired else state}
+            for (row, col), (seat_id, state) in sorted(latest.items())]
@@ -0,0 +1,80 @@
+''' Management command for checking that the hot queries of the api are served by indexes '''
+import json
+import re
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+from apiv1.models import Booking, Schedule, Seat, SeatChange, TripInventory
+from apiv1.utils import expired_holds, live_bookings, trips_with_availability
+
+
+def hot_queries():
+    ''' Returns the name and queryset of every hot query of the api, filtered on sample values '''
+    today = timezone.now().date()
+    return [
+        ('search schedules', Schedule.objects.filter(route_id=1, date=today)),
+        ('search availability', trips_with_availability([1])),
+        ('seat map seats', Seat.objects.filter(layout__vehicletype__vehicle__scheduledvehicle=1).order_by(
+            'row', 'col').values_list('id', 'row', 'col')),
+        ('seat map bookings', live_bookings(trip_id=1, schedule_id=1).values_list('seat_id', 'state')),
+        ('seat by label', Seat.objects.filter(layout_id=1, label='A1')),
+        ('booking history', Booking.objects.filter(booked_by_id=1, schedule__date__gte=today).select_related(
+            'trip__vehicle__vehicle_type', 'schedule__route', 'seat', 'booked_by').order_by('schedule__date', 'id')),
+        ('trip inventory', TripInventory.objects.filter(trip_id=1, schedule_id=1)),
+        ('seat changes', SeatChange.objects.filter(trip_id=1, schedule_id=1, version__gt=0).values_list(
+            'seat__row', 'seat__col', 'state')),
+        ('expired holds', expired_holds()),
+    ]
+
+
+def all_access_tables(node):
+    ''' Yields the tables a MySQL json plan reads in full '''
+    if isinstance(node, dict):
+        if node.get('access_type') == 'ALL':
+            yield node.get('table_name')
+        for value in node.values():
+            yield from all_access_tables(value)
+    elif isinstance(node, list):
+        for value in node:
+            yield from all_access_tables(value)
+
+
+def full_scans(queryset):
+    '''
+    Explains the queryset on the default database and returns the tables its plan reads in
+    full. Postgres is kept off sequential scans while explaining so that a small table does
+    not hide a missing index.
+    '''
+    vendor = connection.vendor
+    if vendor == 'sqlite':
+        plan = queryset.explain()
+        return [match.group(1) for match in re.finditer(r'\bSCAN (?:TABLE )?(\w+)', plan)
+                if match.group(1) not in ('CONSTANT', 'SUBQUERY')]
+    if vendor == 'postgresql':
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+            plan = queryset.explain()
+        return re.findall(r'Seq Scan on (\w+)', plan)
+    if vendor == 'mysql':
+        return list(all_access_tables(json.loads(queryset.explain(format='json'))))
+    raise CommandError(f'Query plans of {vendor} databases cannot be audited')
+
+
+class Command(BaseCommand):
+    ''' Runs EXPLAIN on every hot query and fails when one of them scans a whole table '''
+    help = 'Checks that the hot queries use indexes instead of full table scans'
+
+    def handle(self, *args, **options):
+        failed = []
+        for name, queryset in hot_queries():
+            scans = full_scans(queryset)
+            if options['verbosity'] > 1:
+                self.stdout.write(queryset.explain())
+            if scans:
+                failed.append(name)
+                self.stdout.write(f'{name}: full scan of {", ".join(scans)}')
+            else:
+                self.stdout.write(f'{name}: ok')
+        if failed:
+            raise CommandError(f'{len(failed)} hot queries scan whole tables: {", ".join(failed)}')
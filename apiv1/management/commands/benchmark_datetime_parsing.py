@@ -0,0 +1,32 @@
+''' Management command comparing the datetime parsing paths '''
+import timeit
+import dateutil.parser
+from django.core.management.base import BaseCommand
+from apiv1.utils import parse_datetime_str, datetime_str_to_object
+
+SAMPLES = (
+    '2019-11-16T08:15:00.000',
+    '2019-11-16T18:15:00.000',
+    '2019-11-17T08:15:00.000',
+    '2019-11-16',
+)
+
+
+class Command(BaseCommand):
+    ''' Times dateutil against the iso parsing path with and without the memo '''
+    help = 'Micro-benchmark of datetime_str_to_object against dateutil'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--number', type=int, default=20000, help='Parses per sample string')
+
+    def handle(self, *args, **options):
+        number = options['number']
+        paths = (
+            ('dateutil.parser.parse', dateutil.parser.parse),
+            ('parse_datetime_str', parse_datetime_str),
+            ('datetime_str_to_object (memo)', datetime_str_to_object),
+        )
+        for name, parse in paths:
+            seconds = min(timeit.repeat(lambda parse=parse: [parse(sample) for sample in SAMPLES],
+                                        number=number, repeat=3))
+            self.stdout.write(f'{name:32} {seconds * 1e6 / (number * len(SAMPLES)):8.2f} us/parse')
@@ -0,0 +1,154 @@
+''' Management command for benchmarking every endpoint of the api against the seeded data '''
+import datetime
+import json
+import time
+import tracemalloc
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import Client
+from django.utils import timezone
+from apiv1 import urls
+from apiv1.models import Booking, Schedule, ScheduledVehicle, Seat
+
+API_PREFIX = '/api/v1/'
+
+
+def percentile(values, fraction):
+    ''' Nearest rank percentile of the values '''
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, round(fraction * (len(ordered) - 1)))]
+
+
+def endpoint_requests():
+    '''
+    Returns the requests to benchmark for every url pattern of the api as (pattern, name,
+    method, path, body) tuples, made up from the first booked trip of the database. Writes
+    book, bulk book and hold free seats of that trip.
+    '''
+    booking = Booking.objects.exclude(booked_by=None).select_related(
+        'trip__vehicle__vehicle_type', 'schedule', 'booked_by').order_by('id').first()
+    if booking is None:
+        raise CommandError('There are no bookings to benchmark against, run seed_fleet first')
+    trip, schedule, user = booking.trip, booking.schedule, booking.booked_by
+    taken = Booking.objects.filter(trip=trip, schedule=schedule).values_list('seat_id', flat=True)
+    free = list(Seat.objects.filter(layout_id=trip.vehicle.vehicle_type.layout_id).exclude(id__in=taken).order_by(
+        'row', 'col').values_list('label', flat=True)[:4])
+    if len(free) < 4:
+        raise CommandError(f'Trip {trip.id} needs 4 free seats on schedule {schedule.id}, seed a lower fill rate')
+    same_day = ScheduledVehicle.schedule.through.objects.filter(schedule__date=schedule.date).order_by('id')[:10]
+    details = {'trip': trip.id, 'schedule': schedule.id, 'bookedBy': str(user.unique_id),
+               'passengerName': 'Benchmark Passenger', 'passengerPhone': 9800000000, 'amount': 1000,
+               'isPaid': True, 'paymentMethod': 'Cash', 'bookedOn': timezone.now().isoformat()}
+    return user, [
+        ('layouts/', 'layouts', 'GET', 'layouts/', None),
+        ('routes/', 'routes', 'GET', 'routes/', None),
+        ('vehicletypes/', 'vehicle types', 'GET', 'vehicletypes/', None),
+        ('vehicles/', 'vehicles', 'GET', 'vehicles/', None),
+        ('schedule/', 'schedule', 'GET', 'schedule/', None),
+        ('schedule/', 'schedule page', 'GET', 'schedule/?limit=50', None),
+        ('scheduledvehicles/', 'scheduled vehicles', 'GET', 'scheduledvehicles/', None),
+        ('scheduledvehicles/<int:v_id>/', 'scheduled vehicle', 'GET', f'scheduledvehicles/{trip.id}/', None),
+        ('scheduledvehicles/<int:v_id>/<int:s_id>/', 'seat map', 'GET',
+         f'scheduledvehicles/{trip.id}/{schedule.id}/', None),
+        ('scheduledvehicles/<int:v_id>/<int:s_id>/', 'seat map compact', 'GET',
+         f'scheduledvehicles/{trip.id}/{schedule.id}/?format=compact', None),
+        ('seatmaps/', 'seat maps', 'POST', 'seatmaps/',
+         {'trips': [{'trip': row.scheduledvehicle_id, 'schedule': row.schedule_id} for row in same_day]}),
+        ('search/', 'search', 'POST', 'search/',
+         {'route': schedule.route_id, 'date': datetime.datetime.combine(schedule.date, schedule.time).isoformat()}),
+        ('book/', 'booking history', 'GET', 'book/?limit=50', None),
+        ('book/', 'book', 'POST', 'book/', dict(details, seat=free[0])),
+        ('book/bulk/', 'bulk book', 'POST', 'book/bulk/', dict(details, seats=free[1:3])),
+        ('hold/', 'hold', 'POST', 'hold/',
+         {'trip': trip.id, 'schedule': schedule.id, 'seat': free[3], 'bookedBy': str(user.unique_id)}),
+    ]
+
+
+class Command(BaseCommand):
+    '''
+    Drives every url pattern of the api through the test client and reports the p50 and p95
+    latency, the number of queries and the peak memory of each request. Every request runs
+    in a transaction that is rolled back, so writes can be repeated.
+    '''
+    help = 'Benchmarks every api endpoint and saves the results as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=20, help='Timed runs of every request')
+        parser.add_argument('--warmup', type=int, default=2, help='Untimed runs before the timed ones')
+        parser.add_argument('--output', help='File to save the results to as JSON')
+        parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+        parser.add_argument('--label', default='', help='Label saved with the results, like a commit hash')
+
+    def run(self, client, method, path, body):
+        ''' Sends the request inside a rolled back transaction, returns the response with its body read '''
+        with transaction.atomic():
+            if method == 'GET':
+                response = client.get(path)
+            else:
+                response = client.post(path, json.dumps(body), content_type='application/json')
+            if response.streaming:
+                response.content = b''.join(response.streaming_content)
+            transaction.set_rollback(True)
+        return response
+
+    def measure(self, client, method, path, body, options):
+        ''' Returns the result of benchmarking one request '''
+        timings = []
+        for index in range(options['warmup'] + options['iterations']):
+            start = time.perf_counter()
+            response = self.run(client, method, path, body)
+            if index >= options['warmup']:
+                timings.append((time.perf_counter() - start) * 1000)
+        # counted by a wrapper, request_started empties the queries log CaptureQueriesContext reads
+        queries = []
+        with connection.execute_wrapper(lambda execute, sql, *args: queries.append(sql) or execute(sql, *args)):
+            self.run(client, method, path, body)
+        tracemalloc.start()
+        self.run(client, method, path, body)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result = {'status': response.status_code, 'p50_ms': round(percentile(timings, 0.5), 3),
+                  'p95_ms': round(percentile(timings, 0.95), 3), 'queries': len(queries),
+                  'peak_kib': round(peak / 1024, 1), 'bytes': len(response.content)}
+        if response.get('Content-Type') == 'application/json' and 'error' in json.loads(response.content or b'{}'):
+            result['error'] = json.loads(response.content)['error']
+        return result
+
+    def handle(self, *args, **options):
+        if options['iterations'] < 1:
+            raise CommandError('At least one iteration is needed')
+        user, requests = endpoint_requests()
+        client = Client()
+        client.force_login(user)
+        covered = {pattern for pattern, _, _, _, _ in requests}
+        for pattern in urls.urlpatterns:
+            if str(pattern.pattern) not in covered:
+                self.stderr.write(f'No benchmark for {pattern.pattern}')
+        results = []
+        for pattern, name, method, path, body in requests:
+            result = {'name': name, 'method': method, 'path': API_PREFIX + path}
+            result.update(self.measure(client, method, API_PREFIX + path, body, options))
+            results.append(result)
+        earlier = {}
+        if options['compare']:
+            with open(options['compare']) as compare_file:
+                earlier = {result['name']: result for result in json.load(compare_file)['endpoints']}
+        self.stdout.write(f'{"endpoint":22} {"p50 ms":>9} {"p95 ms":>9} {"queries":>8} {"peak KiB":>10}')
+        for result in results:
+            line = (f'{result["name"]:22} {result["p50_ms"]:9.2f} {result["p95_ms"]:9.2f} {result["queries"]:8} '
+                    f'{result["peak_kib"]:10.1f}')
+            if result['name'] in earlier:
+                before = earlier[result['name']]
+                line += (f'  p50 {result["p50_ms"] - before["p50_ms"]:+.2f} ms, '
+                         f'queries {result["queries"] - before["queries"]:+}')
+            if 'error' in result:
+                line += f'  error: {result["error"]}'
+            self.stdout.write(line)
+        if options['output']:
+            with open(options['output'], 'w') as output_file:
+                json.dump({
+                    'label': options['label'], 'database': connection.vendor, 'created_on': timezone.now().isoformat(),
+                    'iterations': options['iterations'], 'schedules': Schedule.objects.count(),
+                    'bookings': Booking.objects.count(), 'endpoints': results,
+                }, output_file, indent=2)
+            self.stdout.write(f'Saved the results to {options["output"]}')
@@ -0,0 +1,46 @@
+''' Management command comparing memory use of buffered and streamed list responses '''
+import datetime
+import tracemalloc
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test import RequestFactory
+from apiv1 import views
+from apiv1.models import Route, Schedule
+
+
+class Command(BaseCommand):
+    ''' Reports the memory high-water mark of the schedule list with and without streaming '''
+    help = 'Memory benchmark of streaming list responses'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', type=int, default=0,
+                            help='Schedules to add for the run, they are rolled back afterwards')
+
+    def measure(self, path):
+        ''' Returns the response size and the peak memory of rendering the schedule list '''
+        request = RequestFactory().get(path)
+        tracemalloc.start()
+        response = views.schedule(request)
+        if response.streaming:
+            size = sum(len(chunk) for chunk in response.streaming_content)
+        else:
+            size = len(response.content)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return size, peak
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            if options['seed']:
+                route, _ = Route.objects.get_or_create(source='Benchmark Source', destination='Benchmark Destination')
+                start = datetime.date(2030, 1, 1)
+                Schedule.objects.bulk_create(
+                    Schedule(route=route, date=start + datetime.timedelta(days=index // 24),
+                             time=datetime.time(index % 24), nature='Day')
+                    for index in range(options['seed'])
+                )
+            self.stdout.write(f'{Schedule.objects.count()} schedules')
+            for name, path in (('buffered', '/api/v1/schedule/'), ('streamed', '/api/v1/schedule/?stream=1')):
+                size, peak = self.measure(path)
+                self.stdout.write(f'{name:10} {size / 1024:10.1f} KiB body {peak / 1024:10.1f} KiB peak')
+            transaction.set_rollback(True)
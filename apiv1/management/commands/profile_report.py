@@ -0,0 +1,42 @@
+''' Management command for reading the request profiles written by the profiling middleware '''
+import os
+import pstats
+import re
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# <time>-<pid>-<url name>-<milliseconds>ms.prof, as named by yatri_bus.middleware.profile_name
+PROFILE_NAME = re.compile(r'^\d+-\d+-(?P<view>\w+)-(?P<ms>\d+)ms\.prof$')
+
+
+class Command(BaseCommand):
+    ''' Merges the request profiles and prints the hottest functions along with the time per url name '''
+    help = 'Reports the top functions of the sampled request profiles'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dir', default=getattr(settings, 'PROFILE_DIR', None),
+                            help='Directory of the profiles, PROFILE_DIR by default')
+        parser.add_argument('--view', help='Only the profiles of this url name')
+        parser.add_argument('--top', type=int, default=25, help='Number of functions to list')
+        parser.add_argument('--sort', choices=('cumulative', 'tottime', 'ncalls'), default='cumulative',
+                            help='Order of the functions')
+
+    def handle(self, *args, **options):
+        if not options['dir'] or not os.path.isdir(options['dir']):
+            raise CommandError('No profile directory, pass --dir or set PROFILE_DIR')
+        profiles = {}
+        for name in sorted(os.listdir(options['dir'])):
+            match = PROFILE_NAME.match(name)
+            if match and options['view'] in (None, match.group('view')):
+                profiles[os.path.join(options['dir'], name)] = (match.group('view'), int(match.group('ms')))
+        if not profiles:
+            raise CommandError('No profiles to report on')
+        timings = {}
+        for view, elapsed_ms in profiles.values():
+            timings.setdefault(view, []).append(elapsed_ms)
+        self.stdout.write(f'{"url name":24} {"requests":>8} {"mean ms":>9} {"max ms":>9}')
+        for view, values in sorted(timings.items(), key=lambda item: -sum(item[1])):
+            self.stdout.write(f'{view:24} {len(values):8} {sum(values) / len(values):9.1f} {max(values):9}')
+        self.stdout.write('')
+        stats = pstats.Stats(*profiles, stream=self.stdout)
+        stats.strip_dirs().sort_stats(options['sort']).print_stats(options['top'])
@@ -0,0 +1,55 @@
+''' Management command for rebuilding the trip inventory out of the bookings '''
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+from apiv1.inventory import HOLD
+from apiv1.models import Booking, Seat, ScheduledVehicle, TripInventory
+
+
+class Command(BaseCommand):
+    '''
+    Counts every trip inventory from scratch, reports the rows that drifted and fixes them.
+    Trips with bookings but no inventory get one, which backfills the trips booked before
+    the inventory existed. Search counts their bookings until then.
+    '''
+    help = 'Rebuilds TripInventory from Booking and reports drift'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only report the drift')
+
+    def handle(self, *args, **options):
+        seat_counts = dict(Seat.objects.order_by().values_list('layout_id').annotate(count=Count('id')))
+        layouts = dict(ScheduledVehicle.objects.values_list('id', 'vehicle__vehicle_type__layout_id'))
+        drifted = 0
+        with transaction.atomic():
+            # counted once the rows are locked, so that bookings written meanwhile wait for the fix
+            inventories = list(TripInventory.objects.select_for_update())
+            counted = {}
+            bookings = Booking.objects.filter(trip__isnull=False, schedule__isnull=False).order_by().values(
+                'trip_id', 'schedule_id').annotate(locked=Count('id', filter=HOLD), booked=Count('id', filter=~HOLD))
+            for row in bookings:
+                counted[(row['trip_id'], row['schedule_id'])] = TripInventory(
+                    trip_id=row['trip_id'], schedule_id=row['schedule_id'],
+                    total=seat_counts.get(layouts.get(row['trip_id']), 0), booked=row['booked'], locked=row['locked'])
+            for inventory in inventories:
+                expected = counted.pop((inventory.trip_id, inventory.schedule_id), None)
+                if expected is None:
+                    # every booking of the trip is gone, the counts fall back to zero
+                    expected = TripInventory(trip_id=inventory.trip_id, schedule_id=inventory.schedule_id,
+                                             total=seat_counts.get(layouts.get(inventory.trip_id), 0))
+                found = (inventory.total, inventory.booked, inventory.locked)
+                wanted = (expected.total, expected.booked, expected.locked)
+                if found != wanted:
+                    drifted += 1
+                    self.stdout.write(f'trip {inventory.trip_id} schedule {inventory.schedule_id}: '
+                                      f'total/booked/locked {found} should be {wanted}')
+                    if not options['dry_run']:
+                        inventory.total, inventory.booked, inventory.locked = wanted
+                        inventory.save()
+            for inventory in counted.values():
+                drifted += 1
+                self.stdout.write(f'trip {inventory.trip_id} schedule {inventory.schedule_id}: missing')
+            if not options['dry_run']:
+                # a trip counted by its first booking meanwhile keeps that count
+                TripInventory.objects.bulk_create(counted.values(), ignore_conflicts=True)
+        self.stdout.write(f'{drifted} inventories drifted')
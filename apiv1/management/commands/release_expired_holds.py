@@ -0,0 +1,23 @@
+''' Management command for releasing seat holds that have run out '''
+import time
+from django.core.management.base import BaseCommand
+from apiv1.inventory import prune_seat_changes, release_holds
+from apiv1.utils import expired_holds
+
+
+class Command(BaseCommand):
+    ''' Deletes every expired hold in one go and prunes the seat change log, optionally every few seconds '''
+    help = 'Releases the seats of expired holds'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--every', type=int, default=0,
+                            help='Keep running and sweep every this many seconds')
+
+    def handle(self, *args, **options):
+        while True:
+            released = release_holds(expired_holds())
+            self.stdout.write(f'Released {released} expired holds')
+            self.stdout.write(f'Pruned {prune_seat_changes()} seat changes')
+            if not options['every']:
+                break
+            time.sleep(options['every'])
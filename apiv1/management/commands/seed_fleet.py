@@ -0,0 +1,102 @@
+''' Management command for filling the database with a synthetic bus network '''
+import datetime
+import random
+from io import StringIO
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from users.models import CustomUserBase
+from apiv1.models import Booking, Route, Schedule, ScheduledVehicle, Vehicle, VehicleType
+from apiv1.utils import json_to_layouts
+
+# departures of every route on every day
+DEPARTURES = ((datetime.time(6, 30), 'Day'), (datetime.time(19), 'Night'))
+
+
+class Command(BaseCommand):
+    '''
+    Seeds routes, layouts, vehicle types, vehicles, a schedule of every departure of every
+    route for each day and bookings up to a fill rate, all made by the seed user
+    '''
+    help = 'Seeds a synthetic network of routes, vehicles, schedules and bookings'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--routes', type=int, default=10, help='Number of routes')
+        parser.add_argument('--layouts', type=int, default=3, help='Number of layouts, one vehicle type each')
+        parser.add_argument('--vehicles', type=int, default=40, help='Number of vehicles')
+        parser.add_argument('--days', type=int, default=90, help='Days of schedules from --start')
+        parser.add_argument('--fill', type=float, default=0.5, help='Share of the seats of every trip to book')
+        parser.add_argument('--start', type=datetime.date.fromisoformat, default=None,
+                            help='First day of the schedules, today by default')
+        parser.add_argument('--random-seed', type=int, default=0, help='Seed of the random seat picks')
+
+    def create_layouts(self, count):
+        ''' Creates layouts of 2+2 seats a row with 8 to 12 rows and a vehicle type for each '''
+        data_list = []
+        for index in range(count):
+            rows = 8 + index % 5
+            data_list.append({'name': f'Seed Layout {index + 1}', 'data': [
+                [{'is_active': col != 2, 'label': f'{chr(65 + row)}{col}'} for col in range(5)]
+                for row in range(rows)
+            ]})
+        layout_ids = [result['id'] for result in json_to_layouts(data_list)]
+        return [VehicleType.objects.create(name=f'Seed Type {index + 1}', layout_id=layout_id)
+                for index, layout_id in enumerate(layout_ids)]
+
+    def create_routes(self, count):
+        ''' Creates routes between seed towns, each town pair in both directions '''
+        towns = [f'Seed Town {index + 1}' for index in range(count // 2 + 2)]
+        pairs = [(source, destination) for source in towns for destination in towns if source != destination]
+        return [Route.objects.get_or_create(source=source, destination=destination)[0]
+                for source, destination in pairs[:count]]
+
+    def handle(self, *args, **options):
+        if min(options['routes'], options['layouts'], options['vehicles'], options['days']) < 1:
+            raise CommandError('Routes, layouts, vehicles and days must be at least 1')
+        if not 0 <= options['fill'] <= 1:
+            raise CommandError('The fill rate must be between 0 and 1')
+        picker = random.Random(options['random_seed'])
+        start = options['start'] or timezone.now().date()
+        with transaction.atomic():
+            user, _ = CustomUserBase.objects.get_or_create(
+                username='seed', defaults={'first_name': 'Seed', 'last_name': 'User'})
+            vehicle_types = self.create_layouts(options['layouts'])
+            routes = self.create_routes(options['routes'])
+            vehicles = [Vehicle.objects.create(vehicle_type=vehicle_types[index % len(vehicle_types)],
+                                               number_plate=f'SEED {index + 1}')
+                        for index in range(options['vehicles'])]
+            last_schedule_id = Schedule.objects.order_by('-id').values_list('id', flat=True).first() or 0
+            schedules = Schedule.objects.bulk_create((
+                Schedule(route=route, date=start + datetime.timedelta(days=day), time=departure, nature=nature)
+                for route in routes for day in range(options['days']) for departure, nature in DEPARTURES
+            ))
+            if not all(schedule.id for schedule in schedules):
+                # backends that do not return ids from bulk inserts
+                schedules = list(Schedule.objects.filter(id__gt=last_schedule_id).order_by('id'))
+            # every vehicle runs one departure of its route a day
+            departures = {}
+            for schedule in schedules:
+                departures.setdefault((schedule.route_id, schedule.time), []).append(schedule)
+            runs = sorted(departures)
+            trips = []
+            for index, vehicle in enumerate(vehicles):
+                trip = ScheduledVehicle.objects.create(vehicle=vehicle)
+                trip.schedule.add(*departures[runs[index % len(runs)]])
+                trips.append((trip, departures[runs[index % len(runs)]]))
+            seats = {vehicle_type.layout_id: list(vehicle_type.layout.seat_set.values_list('id', flat=True))
+                     for vehicle_type in vehicle_types}
+            booked_on = timezone.now()
+            bookings = []
+            for trip, trip_schedules in trips:
+                layout_seats = seats[trip.vehicle.vehicle_type.layout_id]
+                for schedule in trip_schedules:
+                    for seat_id in picker.sample(layout_seats, round(len(layout_seats) * options['fill'])):
+                        bookings.append(Booking(trip=trip, schedule=schedule, seat_id=seat_id, booked_by=user,
+                                                passenger_name='Seed Passenger', passenger_phone=9800000000,
+                                                amount=1000, is_paid=True, payment_method='Cash',
+                                                booked_on=booked_on, state='booked'))
+            Booking.objects.bulk_create(bookings)
+            call_command('reconcile_inventory', stdout=StringIO())
+        self.stdout.write(f'Seeded {len(routes)} routes, {len(vehicle_types)} layouts, {len(vehicles)} vehicles, '
+                          f'{len(schedules)} schedules and {len(bookings)} bookings')
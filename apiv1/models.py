@@ -1,10 +1,38 @@
 ''' Models module for api '''
 import django
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.utils import timezone
 from .exceptions import RouteValueException, EmptyValueException
+from .cache import layout_grid_cache
 from users.models import CustomUserBase
 
 
+class CatalogVersion(models.Model):
+    '''
+    Version stamp of a catalog table, bumped on every write to the table so that the GETs of
+    the catalog can be answered with a 304 when nothing changed
+    '''
+    name = models.CharField(max_length=31, unique=True)
+    version = models.PositiveIntegerField(default=0)
+    modified_on = models.DateTimeField()
+
+    def __str__(self):
+        return f'{self.name}: {self.version}'
+
+    @classmethod
+    def bump(cls, name):
+        ''' Bumps the version of the named table '''
+        now = timezone.now()
+        if cls.objects.filter(name=name).update(version=models.F('version') + 1, modified_on=now):
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(name=name, version=1, modified_on=now)
+        except IntegrityError:
+            # created by a concurrent write
+            cls.objects.filter(name=name).update(version=models.F('version') + 1, modified_on=now)
+
+
 class Layout(models.Model):
     ''' Information about Seat layout '''
     REQUIRED_FIELDS = ('name',)
@@ -17,11 +45,18 @@ class Layout(models.Model):
     def delete(self, using=None, keep_parents=False):
         raise Exception('Cannot delete a read only model object')
 
+    @staticmethod
+    def normalize_name(name):
+        ''' Returns the name as layouts are saved with, also used by the bulk insert of layouts '''
+        return str(name).lower().title()
+
     def save(self, *args, **kwargs):    # pylint: disable=arguments-differ
         if self.name == "":
             raise Exception('Cannot save layout with no name')
-        self.name = str(self.name).lower().title()
+        self.name = self.normalize_name(self.name)
         super(Layout, self).save(*args, **kwargs)
+        layout_grid_cache.invalidate(self.id)
+        CatalogVersion.bump('layout')
 
 
 class Seat(models.Model):
@@ -31,12 +66,21 @@ class Seat(models.Model):
     col = models.PositiveIntegerField()
     row = models.PositiveIntegerField()
 
+    class Meta:
+        # seats get looked up by label when booking
+        indexes = [models.Index(fields=['layout', 'label'])]
+
     def __str__(self):
         return f'Seat: {self.layout.name}, {self.label}'
 
     def delete(self, using=None, keep_parents=False):
         raise Exception('Cannot delete a read only model object')
 
+    def save(self, *args, **kwargs):    # pylint: disable=arguments-differ
+        super(Seat, self).save(*args, **kwargs)
+        layout_grid_cache.invalidate(self.layout_id)
+        CatalogVersion.bump('layout')
+
 
 class VehicleType(models.Model):
     ''' For Storing data about the vehicle type.'''
@@ -49,6 +93,7 @@ class VehicleType(models.Model):
     def save(self, *args, **kwargs):    # pylint: disable=arguments-differ
         self.name = str(self.name).lower().title()
         super(VehicleType, self).save(*args, **kwargs)
+        CatalogVersion.bump('vehicletype')
 
     def __str__(self):
         return f'Layout: {self.name}, {self.layout.seat_set.count()} seats'
@@ -92,6 +137,7 @@ class Route(models.Model):
             self.source = str(self.source).lower().title()
             self.destination = str(self.destination).lower().title()
             super(Route, self).save(*args, **kwargs)
+            CatalogVersion.bump('route')
         else:
             raise Exception("Route cannot be edited once created.")
 
@@ -110,12 +156,14 @@ class Vehicle(models.Model):
     def delete(self, using=None, keep_parents=False, super_admin=None): # pylint: disable=arguments-differ
         if super_admin:
             super(Vehicle, self).delete()
+            CatalogVersion.bump('vehicle')
         else:
             raise Exception('Cannot delete a read only model object')
 
     def save(self, *args, **kwargs):    # pylint: disable=arguments-differ
         self.number_plate = str(self.number_plate).upper()
         super(Vehicle, self).save(*args, **kwargs)
+        CatalogVersion.bump('vehicle')
 
 
 class Schedule(models.Model):
@@ -130,6 +178,10 @@ class Schedule(models.Model):
     )
     nature = models.CharField(max_length=6, choices=PERIODS, default='BOTH')
 
+    class Meta:
+        # search and the schedule upsert look schedules up by route and date
+        indexes = [models.Index(fields=['route', 'date'])]
+
     def save(self, *args, **kwargs):    # pylint: disable=arguments-differ
         if not self.pk:
             super(Schedule, self).save(*args, **kwargs)
@@ -175,6 +227,66 @@ class Booking(models.Model):
         ('booked', 'booked'),
     )
     state = models.CharField(max_length=15, choices=STATES, default='locked ')
+    # set for seat holds, a locked booking is released once this time has passed
+    expires_on = models.DateTimeField(default=None, blank=True, null=True)
 
     class Meta:
         unique_together = ['trip', 'schedule', 'seat']
+        indexes = [
+            # the booking history of a user joins the schedules for their dates
+            models.Index(fields=['booked_by', 'schedule']),
+            # the sweeper looks for holds that have run out
+            models.Index(fields=['expires_on']),
+        ]
+
+
+class TripInventory(models.Model):
+    '''
+    Seat counts of a scheduled vehicle on a schedule, updated along with every booking write
+    so that availability is a single row lookup. Holds count as locked, every other booking
+    as booked.
+    '''
+    trip = models.ForeignKey(ScheduledVehicle, on_delete=models.CASCADE)
+    schedule = models.ForeignKey(Schedule, on_delete=models.CASCADE)
+    total = models.PositiveIntegerField(default=0)
+    booked = models.IntegerField(default=0)
+    locked = models.IntegerField(default=0)
+    # bumped on every seat state change of the trip, numbers the SeatChange rows
+    version = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ['trip', 'schedule']
+
+    def __str__(self):
+        return f'Inventory: {self.trip}, {self.schedule}, {self.booked + self.locked}/{self.total}'
+
+    @property
+    def available(self):
+        ''' Seats that are neither booked nor held '''
+        return max(self.total - self.booked - self.locked, 0)
+
+    @property
+    def unbooked(self):
+        ''' Seats that are not booked, held seats included as they may still free up '''
+        return max(self.total - self.booked, 0)
+
+    @property
+    def sold_out(self):
+        ''' Tells whether every seat is booked, held seats may still free up '''
+        return not self.unbooked
+
+
+class SeatChange(models.Model):
+    ''' Log of the seat state changes of a trip on a schedule, numbered by the inventory version '''
+    trip = models.ForeignKey(ScheduledVehicle, on_delete=models.CASCADE)
+    schedule = models.ForeignKey(Schedule, on_delete=models.CASCADE)
+    seat = models.ForeignKey(Seat, on_delete=models.CASCADE)
+    # state of the seat after the change, available once its booking is gone
+    state = models.CharField(max_length=15)
+    version = models.PositiveIntegerField()
+
+    class Meta:
+        indexes = [models.Index(fields=['trip', 'schedule', 'version'])]
+
+    def __str__(self):
+        return f'Seat change {self.version}: {self.seat}, {self.state}'
@@ -0,0 +1,76 @@
+''' Keyset pagination for the list views of api '''
+import base64
+import binascii
+import json
+from functools import reduce
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from .exceptions import PaginationException
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+def encode_cursor(values):
+    ''' Packs the ordering values of the last row of a page into an opaque cursor '''
+    return base64.urlsafe_b64encode(json.dumps(values, default=str).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor, length):
+    ''' Unpacks the ordering values out of a cursor '''
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, binascii.Error) as exp:
+        raise PaginationException('Invalid cursor.') from exp
+    if not isinstance(values, list) or len(values) != length:
+        raise PaginationException('Invalid cursor.')
+    return values
+
+
+def is_paginated(request):
+    ''' Tells whether the request asks for a page of the list rather than the whole list '''
+    return 'limit' in request.GET or 'cursor' in request.GET
+
+
+def page_size(request, default=DEFAULT_PAGE_SIZE):
+    ''' Returns the limit asked for in the request, capped at MAX_PAGE_SIZE '''
+    try:
+        limit = int(request.GET.get('limit', default))
+    except ValueError as exp:
+        raise PaginationException('Limit must be a number.') from exp
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def field_value(obj, field):
+    ''' Follows a field path like schedule__date on a model object '''
+    return reduce(getattr, field.split('__'), obj)
+
+
+def after(ordering, values):
+    ''' Returns the filter for the rows coming after values in the given ordering '''
+    conditions = Q()
+    for index, field in enumerate(ordering):
+        equal = {ordering[position]: values[position] for position in range(index)}
+        conditions |= Q(**equal, **{f'{field}__gt': values[index]})
+    return conditions
+
+
+def paginate(queryset, request, ordering=('id',), default=DEFAULT_PAGE_SIZE):
+    '''
+    Returns the page of the queryset after the cursor of the request along with the cursor
+    of the next page (None on the last page). The ordering must end with a unique field so
+    that every row has its own place in it.
+    '''
+    limit = page_size(request, default)
+    queryset = queryset.order_by(*ordering)
+    cursor = request.GET.get('cursor')
+    if cursor:
+        try:
+            queryset = queryset.filter(after(ordering, decode_cursor(cursor, len(ordering))))
+        except (TypeError, ValueError, ValidationError) as exp:
+            raise PaginationException('Invalid cursor.') from exp
+    page = list(queryset[:limit + 1])
+    if len(page) <= limit:
+        return page, None
+    page = page[:limit]
+    return page, encode_cursor([field_value(page[-1], field) for field in ordering])
@@ -1,7 +1,17 @@
 ''' Searializers module for models of api '''
 from rest_framework import serializers
 from .models import VehicleType, Route, Vehicle, Schedule, ScheduledVehicle
-from .utils import layout_to_json
+from .utils import get_layout_json, get_compact_layout_json
+
+
+class DynamicFieldsMixin:
+    ''' Lets a serializer take a fields argument, fields not listed there are never computed '''
+    def __init__(self, *args, **kwargs):
+        fields = kwargs.pop('fields', None)
+        super(DynamicFieldsMixin, self).__init__(*args, **kwargs)
+        if fields is not None:
+            for field_name in set(self.fields) - set(fields):
+                self.fields.pop(field_name)
 
 
 class VehicleTypeSerializer(serializers.ModelSerializer):
@@ -13,8 +23,12 @@ class VehicleTypeSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
     def get_layout(self, obj):
-        ''' Serializer function for layout field '''
-        return layout_to_json(obj.layout)
+        '''
+        Serializer function for layout field, lists pass the layout_version in the context and
+        compact in the context gives the compact form of the layout
+        '''
+        layout_json = get_compact_layout_json if self.context.get('compact') else get_layout_json
+        return layout_json(obj.layout_id, version=self.context.get('layout_version'))
 
 
 class RouteSerializer(serializers.ModelSerializer):
@@ -50,3 +64,21 @@ class ScheduledVehicleSerializer(serializers.ModelSerializer):
     class Meta:
         model = ScheduledVehicle
         fields = '__all__'
+
+
+class VehicleTypeSummarySerializer(VehicleTypeSerializer):
+    ''' Serializer class for VehicleType model in lists, leaves out the layout grid '''
+
+    def get_layout(self, obj):
+        ''' Layout is not part of the summary '''
+        return None
+
+
+class VehicleSummarySerializer(VehicleSerializer):
+    ''' Serializer class for Vehicle model in lists '''
+    vehicleType = VehicleTypeSummarySerializer(source='vehicle_type')
+
+
+class ScheduledVehicleSummarySerializer(DynamicFieldsMixin, ScheduledVehicleSerializer):
+    ''' Serializer class for ScheduledVehicle model in lists, takes in the fields to include '''
+    vehicle = VehicleSummarySerializer()
@@ -1,42 +1,65 @@
 ''' Testing module for api '''
 import json
-from datetime import date, time
+import logging
+import os
+import tempfile
+import threading
+from datetime import date, time, datetime, timedelta, timezone
+from io import StringIO
 
-from django.test import TestCase, Client, RequestFactory
+from django.conf import settings
+from django.core.management import call_command
+from django.db import connection, OperationalError
+from django.http import JsonResponse
+from django.test import TestCase, TransactionTestCase, Client, RequestFactory, skipIfDBFeature, skipUnlessDBFeature
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import resolve
+from django.utils import timezone as django_timezone
+from unittest import skipUnless
 
-from .models import Layout, Route, Seat, Vehicle, VehicleType, Schedule, ScheduledVehicle
-from .utils import layout_to_json, json_to_layout
-
-from .views import vehicle_items
+from users.models import CustomUserBase
+from yatri_bus import metrics
+from yatri_bus.middleware import query_shape, ReplicaRoutingMiddleware
+from yatri_bus.routers import ReplicaRouter
+from .models import Layout, Route, Seat, Vehicle, VehicleType, Schedule, ScheduledVehicle, Booking, CatalogVersion, \
+    TripInventory, SeatChange
+from .utils import layout_to_json, json_to_layout, json_to_layouts, get_seat_booking, get_layout_json, \
+    get_compact_layout_json, parse_datetime_str, layout_version, stream_json_list, expired_holds, COMPACT_MEDIA_TYPE
+from .cache import LayoutGridCache, layout_grid_cache
+from .serializers import VehicleTypeSerializer
+from .views import book, book_bulk, hold
+from .pagination import MAX_PAGE_SIZE
+from .inventory import adjust_inventory, get_inventory, release_holds
+from .management.commands.audit_query_plans import full_scans
 
 
 LAYOUT_DATA = {
-    'id': 1,
     'name': 'Super Deluxe Layout',
     'data': [
-        [{'state': 'available', 'label':'A'}],
-        [{'state': 'available', 'label':'B'}]]
+        [{'is_active': True, 'label':'A'}],
+        [{'is_active': True, 'label':'B'}]]
 }
 
-VEHICLE_ITEM_DATA = {
+SCHEDULED_VEHICLE_DATA = {
         "vehicle": 1,
-        "departureTime": "2019-11-16T18:15:00.000",
-        "departurePoint": "somePlace",
-        "vehicleItems": [
+        "schedule": [
             {
-                "departureDate": "2019-11-16T08:15:00.000",
                 "route":1,
-                "departurePeriod":"Day"
+                "date": "2019-11-16T08:15:00.000",
+                "time": "2019-11-16T18:15:00.000",
+                "nature":"Day"
             },
             {
-                "departureDate": "2019-11-17T18:15:00.000",
                 "route":2,
-                "departurePeriod":"Night"
+                "date": "2019-11-17T18:15:00.000",
+                "time": "2019-11-17T18:15:00.000",
+                "nature":"Night"
             },
             {
-                "departureDate": "2019-11-19T08:15:00.000",
                 "route":1,
-                "departurePeriod":"Day"
+                "date": "2019-11-19T08:15:00.000",
+                "time": "2019-11-19T08:15:00.000",
+                "nature":"Day"
             }
         ]
     }
@@ -45,9 +68,10 @@ class LayoutTestCase(TestCase):
     ''' Class for testing layout model '''
 
     def setUp(self):
-        layout = Layout.objects.create(name='Super Deluxe Layout')
-        Seat.objects.create(col=0, row=0, state='available', label='A', layout=layout)
-        Seat.objects.create(col=0, row=1, state='available', label='B', layout=layout)
+        layout_grid_cache.clear()
+        self.layout = Layout.objects.create(name='Super Deluxe Layout')
+        Seat.objects.create(col=0, row=0, label='A', layout=self.layout)
+        Seat.objects.create(col=0, row=1, label='B', layout=self.layout)
 
     def test_layout(self):
         ''' Creates a layout and add two seats then verify if the seat count is 2 or not '''
@@ -57,63 +81,1329 @@ class LayoutTestCase(TestCase):
     def test_layout_to_json(self):
         ''' Tests layout to json function '''
         layout = Layout.objects.get(name='Super Deluxe Layout')
-        self.assertEqual(layout_to_json(layout), LAYOUT_DATA)
+        self.assertEqual(layout_to_json(layout), dict(LAYOUT_DATA, id=layout.id))
 
     def test_json_to_layout(self):
         ''' Tests layout to json function '''
         layout = json_to_layout(LAYOUT_DATA)
+        seats = layout.seat_set.order_by('row')
         self.assertEqual(layout.name, 'Super Deluxe Layout')
         self.assertEqual(layout.seat_set.count(), 2)
-        self.assertEqual(layout.seat_set.all()[0].col, 0)
-        self.assertEqual(layout.seat_set.all()[0].row, 0)
-        self.assertEqual(layout.seat_set.all()[1].col, 0)
-        self.assertEqual(layout.seat_set.all()[1].row, 1)
+        self.assertEqual(seats[0].col, 0)
+        self.assertEqual(seats[0].row, 0)
+        self.assertEqual(seats[1].col, 0)
+        self.assertEqual(seats[1].row, 1)
 
     def test_get_layouts_view(self):
         ''' Tests get layouts view '''
         client = Client()
         response = client.get('/api/v1/layouts/')
-        self.assertEqual(response.json(), {'layouts': [LAYOUT_DATA]})
+        self.assertEqual(response.json(), {'layouts': [dict(LAYOUT_DATA, id=self.layout.id)]})
 
 
 class VehicleItemTestCase(TestCase):
-    ''' Class for testing vehicle item model '''
+    ''' Class for testing scheduled vehicle model '''
 
     def setUp(self):
         layout = Layout.objects.create(name='Super Deluxe Layout')
-        Seat.objects.create(col=0, row=1, label='A', state='available', layout=layout)
-        Seat.objects.create(col=0, row=0, label='B',state='available', layout=layout)
+        Seat.objects.create(col=0, row=1, label='A', layout=layout)
+        Seat.objects.create(col=0, row=0, label='B', layout=layout)
         vehicle_type = VehicleType.objects.create(name='Super Deluxe', layout=layout)
         route = Route.objects.create(source='Pokhara', destination='Kathmandu')
         vehicle = Vehicle.objects.create(vehicle_type=vehicle_type, number_plate='GA15')
-        vehicle.routes.add(route)
-        vehicle.save()
-        self.vehicle_item = VehicleItem.objects.create(
-            vehicle=vehicle,
-            departure_date=date(2019, 10, 14), departure_time=time(12, 23, 12), departure_point='Bhairab tole',
-            departure_period="Day", route=route)
+        self.vehicle_item = ScheduledVehicle.objects.create(vehicle=vehicle)
+        self.vehicle_item.schedule.add(Schedule.objects.create(route=route, date=date(2019, 10, 14),
+                                                               time=time(12, 23, 12), nature='Day'))
 
     def test_layout(self):
-        ''' Creates a vehicle item object and verifies by priting the seat items '''
+        ''' Creates a scheduled vehicle object and verifies its layout and schedule '''
         self.assertEqual(self.vehicle_item.vehicle.vehicle_type.layout.name, 'Super Deluxe Layout')
+        self.assertEqual(self.vehicle_item.schedule.get().route.source, 'Pokhara')
 
 class RequestTestCase(TestCase):
     ''' Testcase class for functions on views '''
     def setUp(self):
         self.client = Client()
         layout = Layout.objects.create(name='Super Deluxe Layout')
-        Seat.objects.create(col=0, row=1, label='A', state='available', layout=layout)
-        Seat.objects.create(col=0, row=0, label='B', state='available', layout=layout)
+        Seat.objects.create(col=0, row=1, label='A', layout=layout)
+        Seat.objects.create(col=0, row=0, label='B', layout=layout)
         vehicle_type = VehicleType.objects.create(name='Super Deluxe', layout=layout)
         route1 = Route.objects.create(source='Pokhara', destination='Kathmandu')
         route2 = Route.objects.create(source='Kathmandu', destination='Pokhara')
         vehicle = Vehicle.objects.create(vehicle_type=vehicle_type, number_plate='GA15')
-        vehicle.routes.add(route1)
-        vehicle.routes.add(route2)
-        vehicle.save()
+        self.data = dict(SCHEDULED_VEHICLE_DATA, vehicle=vehicle.id, schedule=[
+            dict(entry, route=[route1, route2][entry['route'] - 1].id) for entry in SCHEDULED_VEHICLE_DATA['schedule']
+        ])
 
     def test_vehicle_items_post(self):
-        ''' Tests vehicle_items post function '''
-        body = json.dumps(VEHICLE_ITEM_DATA)
-        response = self.client.post('/api/v1/vehicleitems/', body, content_type='application/json')
-        self.assertEqual(response.json(), {'success': 'Successfully created the vehicleItem.'})
+        ''' Tests scheduled_vehicles post function '''
+        body = json.dumps(self.data)
+        response = self.client.post('/api/v1/scheduledvehicles/', body, content_type='application/json')
+        self.assertEqual(response.json(), {'success': 'Successfully created the vehicle schedule'})
+        self.assertEqual(ScheduledVehicle.objects.get().schedule.count(), 3)
+
+
+def create_trip(seat_count, columns=5):
+    ''' Creates a scheduled vehicle with a layout of seat_count seats and a schedule for it '''
+    layout = Layout.objects.create(name=f'Layout {seat_count}')
+    for index in range(seat_count):
+        Seat.objects.create(layout=layout, label=f'A{index}', row=index // columns, col=index % columns)
+    vehicle_type = VehicleType.objects.create(name=f'Type {seat_count}', layout=layout)
+    vehicle = Vehicle.objects.create(vehicle_type=vehicle_type, number_plate=f'BA {seat_count}')
+    route, _ = Route.objects.get_or_create(source='Pokhara', destination='Kathmandu')
+    schedule = Schedule.objects.create(route=route, date=date(2019, 11, 16), time=time(8, 15), nature='Day')
+    trip = ScheduledVehicle.objects.create(vehicle=vehicle)
+    trip.schedule.add(schedule)
+    return trip, schedule
+
+
+def book_seat(trip, schedule, label, state='booked', expires_on=None):
+    ''' Creates a booking (a hold when it expires) for the seat with the given label '''
+    seat = Seat.objects.get(layout=trip.vehicle.vehicle_type.layout, label=label)
+    booking = Booking.objects.create(trip=trip, schedule=schedule, seat=seat, passenger_name='Passenger',
+                                     passenger_phone=9800000000, amount=1000, payment_method='Cash',
+                                     booked_on=datetime(2019, 11, 15, 8, 15, tzinfo=timezone.utc), state=state,
+                                     expires_on=expires_on)
+    if expires_on:
+        adjust_inventory(trip.id, schedule.id, locked=1)
+    else:
+        adjust_inventory(trip.id, schedule.id, booked=1)
+    return booking
+
+
+class SeatBookingTestCase(TestCase):
+    ''' Testcase class for the seat map of a scheduled vehicle '''
+
+    def test_seat_states(self):
+        ''' Booked seats carry their state, the rest are available and gaps are none '''
+        trip, schedule = create_trip(7)
+        book_seat(trip, schedule, 'A1')
+        book_seat(trip, schedule, 'A5', state='locked')
+        grid = get_seat_booking(trip, schedule)
+        self.assertEqual(len(grid), 2)
+        self.assertEqual([cell['state'] for cell in grid[0]],
+                         ['available', 'booked', 'available', 'available', 'available'])
+        self.assertEqual([cell['state'] for cell in grid[1]],
+                         ['locked', 'available', 'none', 'none', 'none'])
+
+    def test_bookings_of_other_schedule_ignored(self):
+        ''' A booking on another schedule of the same vehicle does not show up '''
+        trip, schedule = create_trip(2)
+        other_schedule = Schedule.objects.create(route=schedule.route, date=date(2019, 11, 17),
+                                                 time=time(8, 15), nature='Day')
+        trip.schedule.add(other_schedule)
+        book_seat(trip, other_schedule, 'A0')
+        self.assertEqual(get_seat_booking(trip, schedule), [[{'state': 'available'}, {'state': 'available'}]])
+
+    def test_constant_query_count(self):
+        ''' The number of queries does not grow with the size of the layout '''
+        for seat_count in (2, 45):
+            trip, schedule = create_trip(seat_count)
+            book_seat(trip, schedule, 'A0')
+            trip = ScheduledVehicle.objects.get(id=trip.id)
+            with self.assertNumQueries(2):
+                get_seat_booking(trip, schedule)
+
+
+class LayoutGridCacheTestCase(TestCase):
+    ''' Testcase class for the layout grid cache '''
+
+    def setUp(self):
+        layout_grid_cache.clear()
+        self.trip, _ = create_trip(4)
+        self.layout = self.trip.vehicle.vehicle_type.layout
+
+    def test_cached_grid(self):
+        ''' The second lookup of a layout only reads the version stamp '''
+        grid = get_layout_json(self.layout.id)
+        self.assertEqual(grid, layout_to_json(self.layout))
+        with self.assertNumQueries(1):
+            self.assertEqual(get_layout_json(self.layout.id), grid)
+        version = layout_version()
+        with self.assertNumQueries(0):
+            self.assertEqual(get_layout_json(self.layout.id, version=version), grid)
+
+    def test_grid_copy(self):
+        ''' Changing a returned grid does not change the cached one '''
+        grid = get_layout_json(self.layout.id)
+        grid['data'][0][0]['label'] = 'X'
+        grid['name'] = None
+        self.assertEqual(get_layout_json(self.layout.id), layout_to_json(self.layout))
+
+    def test_seat_save_invalidates(self):
+        ''' Saving a seat rebuilds the grid of its layout '''
+        get_layout_json(self.layout.id)
+        Seat.objects.create(layout=self.layout, label='B0', row=2, col=0)
+        grid = get_layout_json(self.layout.id)
+        self.assertEqual(len(grid['data']), 3)
+        self.assertEqual(grid['data'][2][0], {'is_active': True, 'label': 'B0'})
+
+    def test_write_of_other_process(self):
+        ''' A seat written and stamped by another process is seen without a local invalidation '''
+        get_layout_json(self.layout.id)
+        Seat.objects.filter(layout=self.layout, label='A0').update(label='Z0')
+        self.assertEqual(get_layout_json(self.layout.id)['data'][0][0]['label'], 'A0')
+        CatalogVersion.bump('layout')
+        self.assertEqual(get_layout_json(self.layout.id)['data'][0][0]['label'], 'Z0')
+
+    def test_size_bound(self):
+        ''' Least recently used grids are dropped once the cache is full '''
+        cache = LayoutGridCache(max_size=2)
+        for layout_id in (1, 2, 1, 3):
+            cache.get(layout_id, lambda layout_id=layout_id: {'id': layout_id}, 0)
+        built = []
+        cache.get(1, lambda: built.append(1) or {'id': 1}, 0)
+        cache.get(2, lambda: built.append(2) or {'id': 2}, 0)
+        self.assertEqual(built, [2])
+
+    def test_serializer_uses_cache(self):
+        ''' Serializing vehicles of an already seen layout does not query the seats '''
+        vehicle_type = self.trip.vehicle.vehicle_type
+        context = {'layout_version': layout_version()}
+        VehicleTypeSerializer(vehicle_type, context=context).data
+        with self.assertNumQueries(0):
+            data = VehicleTypeSerializer(vehicle_type, context=context).data
+        self.assertEqual(data['layout'], layout_to_json(self.layout))
+
+
+def layout_json(name, rows, cols=4):
+    ''' Returns layout json with a grid of rows x cols seats with the last column inactive '''
+    return {
+        'name': name,
+        'data': [[{'is_active': col < cols - 1, 'label': f'{row}{col}'} for col in range(cols)]
+                 for row in range(rows)]
+    }
+
+
+class LayoutCreationTestCase(TestCase):
+    ''' Testcase class for creating layouts out of layout json '''
+
+    def test_seat_inserts_batched(self):
+        ''' Seats of a layout are created with the same number of queries whatever the size '''
+        CatalogVersion.bump('layout')
+        with self.assertNumQueries(5):
+            layout = json_to_layout(layout_json('small', 2))
+        self.assertEqual(layout.seat_set.count(), 6)
+        with self.assertNumQueries(5):
+            layout = json_to_layout(layout_json('sleeper', 15))
+        self.assertEqual(layout.seat_set.count(), 45)
+
+    def test_invalid_cell_rolls_back(self):
+        ''' A broken cell in the grid leaves no half built layout behind '''
+        data = layout_json('broken', 3)
+        del data['data'][2][1]['label']
+        with self.assertRaises(KeyError):
+            json_to_layout(data)
+        self.assertFalse(Layout.objects.exists())
+        self.assertFalse(Seat.objects.exists())
+
+    def test_batch_post(self):
+        ''' Valid layouts of a batch are created and invalid ones get an error each '''
+        body = [layout_json('first', 2), layout_json('', 2), {'name': 'no grid'}, layout_json('second', 3)]
+        response = Client().post('/api/v1/layouts/', json.dumps(body), content_type='application/json')
+        results = response.json()['layouts']
+        self.assertEqual(len(results), 4)
+        self.assertEqual(results[1], {'error': 'LayoutJsonFormatException: Layout name is needed to create a layout'})
+        self.assertEqual(results[2], {'error': "KeyError: 'data'"})
+        first = Layout.objects.get(id=results[0]['id'])
+        second = Layout.objects.get(id=results[3]['id'])
+        self.assertEqual((first.name, first.seat_set.count()), ('First', 6))
+        self.assertEqual((second.name, second.seat_set.count()), ('Second', 9))
+
+    def test_batch_long_label(self):
+        ''' A seat label too long for the seat table fails its own layout only '''
+        long_label = layout_json('long label', 2)
+        long_label['data'][1][0]['label'] = 'ABCDEF'
+        results = json_to_layouts([layout_json('short label', 2), long_label])
+        self.assertEqual(results[1],
+                         {'error': 'LayoutJsonFormatException: Seat label ABCDEF is longer than 5 characters'})
+        self.assertEqual(Layout.objects.get(id=results[0]['id']).name, 'Short Label')
+        self.assertEqual(Layout.objects.count(), 1)
+
+    @skipUnlessDBFeature('can_return_ids_from_bulk_insert')
+    def test_batch_query_count(self):
+        ''' A batch of layouts is created in a fixed number of queries '''
+        CatalogVersion.bump('layout')
+        with self.assertNumQueries(5):
+            json_to_layouts([layout_json('one', 2), layout_json('two', 3)])
+        with self.assertNumQueries(5):
+            json_to_layouts([layout_json(str(index), 4) for index in range(10)])
+
+    @skipIfDBFeature('can_return_ids_from_bulk_insert')
+    def test_batch_query_count_without_returned_ids(self):
+        ''' Backends that cannot return the inserted ids look them up in a fixed number of queries '''
+        CatalogVersion.bump('layout')
+        with self.assertNumQueries(7):
+            json_to_layouts([layout_json('one', 2), layout_json('two', 3)])
+        with self.assertNumQueries(7):
+            results = json_to_layouts([layout_json('same', index + 1) for index in range(10)])
+        self.assertEqual([Seat.objects.filter(layout_id=result['id']).count() for result in results],
+                         list(range(3, 33, 3)))
+        self.assertEqual(CatalogVersion.objects.get(name='layout').version, 3)
+
+
+class ScheduledVehicleListTestCase(TestCase):
+    ''' Testcase class for the list of scheduled vehicles and the search '''
+
+    def setUp(self):
+        layout_grid_cache.clear()
+        self.client = Client()
+        self.trip, self.schedule = create_trip(6)
+
+    def assertNoSeatQueries(self, context):    # pylint: disable=invalid-name
+        ''' Fails if any of the captured queries read the seat table '''
+        self.assertFalse([query for query in context.captured_queries if 'apiv1_seat' in query['sql']])
+
+    def test_list_without_layout(self):
+        ''' The list carries the schedules but never builds the layout grid '''
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/api/v1/scheduledvehicles/')
+        self.assertNoSeatQueries(context)
+        data = response.json()['scheduledVehicles'][0]
+        self.assertIsNone(data['vehicle']['vehicleType']['layout'])
+        self.assertEqual(data['vehicle']['numberPlate'], 'BA 6')
+        self.assertEqual([schedule['id'] for schedule in data['schedule']], [self.schedule.id])
+
+    def test_list_fields(self):
+        ''' Fields left out of ?fields= are neither computed nor returned '''
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/api/v1/scheduledvehicles/?fields=id,vehicle')
+        self.assertFalse([query for query in context.captured_queries if '"apiv1_schedule"' in query['sql']])
+        self.assertEqual(list(response.json()['scheduledVehicles'][0]), ['id', 'vehicle'])
+
+    def test_search_without_layout(self):
+        ''' Search results carry the searched schedule and no layout grid '''
+        body = json.dumps({'route': self.schedule.route.id, 'date': '2019-11-16T08:15:00.000'})
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.post('/api/v1/search/', body, content_type='application/json')
+        # the seats are only counted, by a subquery of the trips query
+        seat_queries = [query['sql'] for query in context.captured_queries if 'apiv1_seat' in query['sql']]
+        self.assertEqual(len(seat_queries), 1)
+        self.assertTrue(seat_queries[0].startswith('SELECT "apiv1_scheduledvehicle_schedule"'))
+        self.assertIn('SELECT COUNT(U0."id") AS "count" FROM "apiv1_seat" U0', seat_queries[0])
+        data = response.json()['scheduledVehicles']
+        self.assertEqual(len(data), 1)
+        self.assertEqual(list(data[0]), ['id', 'vehicle', 'schedule', 'totalSeats', 'availableSeats'])
+        self.assertIsNone(data[0]['vehicle']['vehicleType']['layout'])
+        self.assertEqual(data[0]['schedule']['id'], self.schedule.id)
+
+
+class SearchQueryBudgetTestCase(TestCase):
+    ''' Testcase class for the number of queries of the search '''
+
+    def test_query_budget(self):
+        ''' 50 schedules with 5 vehicles each are searched with a fixed number of queries '''
+        trips = [create_trip(2)[0] for _ in range(5)]
+        route = Route.objects.get(source='Pokhara', destination='Kathmandu')
+        schedules = [Schedule.objects.create(route=route, date=date(2019, 11, 20), time=time(6, minute), nature='Day')
+                     for minute in range(50)]
+        for trip in trips:
+            trip.schedule.add(*schedules)
+        body = json.dumps({'route': route.id, 'date': '2019-11-20T08:15:00.000'})
+        with self.assertNumQueries(3):
+            response = Client().post('/api/v1/search/', body, content_type='application/json')
+        data = response.json()['scheduledVehicles']
+        self.assertEqual(len(data), 250)
+        self.assertEqual(data[0]['schedule']['route']['id'], route.id)
+        self.assertEqual(data[0]['vehicle']['vehicleType']['name'], 'Type 2')
+
+
+def booking_json(trip, schedule, label, user):
+    ''' Returns the request json for booking the seat with the given label '''
+    return {
+        'trip': trip.id,
+        'schedule': schedule.id,
+        'seat': label,
+        'bookedBy': str(user.unique_id),
+        'passengerName': 'Passenger',
+        'passengerPhone': 9800000000,
+        'amount': 1000,
+        'isPaid': True,
+        'paymentMethod': 'Khalti',
+        'bookedOn': '2019-11-15T18:15:00.000'
+    }
+
+
+class ConcurrentBookingTestCase(TransactionTestCase):
+    ''' Testcase class for booking the same seats from many threads at once '''
+
+    def post_booking(self, body, user):
+        ''' Posts the booking straight to the view, retrying while the database is locked '''
+        request = RequestFactory().post('/api/v1/book/', json.dumps(body), content_type='application/json')
+        request.user = user
+        while True:
+            try:
+                return json.loads(book(request).content)
+            except OperationalError:
+                # sqlite allows a single writer at a time
+                continue
+
+    def test_one_winner_per_seat(self):
+        ''' Out of hundreds of concurrent bookings for a few seats exactly one wins each seat '''
+        trip, schedule = create_trip(4)
+        user = CustomUserBase.objects.create(username='agent', first_name='Test', last_name='Agent')
+        labels = ['A0', 'A1', 'A2', 'A3']
+        results = []
+        barrier = threading.Barrier(8)
+
+        def worker(index):
+            barrier.wait()
+            try:
+                for attempt in range(25):
+                    label = labels[(index + attempt) % len(labels)]
+                    results.append((label, self.post_booking(booking_json(trip, schedule, label, user), user)))
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker, args=(index,)) for index in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(results), 200)
+        winners = [label for label, result in results if 'bookedingId' in result]
+        self.assertEqual(sorted(winners), labels)
+        losers = [result for _, result in results if 'bookedingId' not in result]
+        self.assertTrue(all(result['error'] in ('This Seat is already booked by someone else.',
+                                                'This trip is sold out.') for result in losers))
+        self.assertEqual(Booking.objects.filter(trip=trip, schedule=schedule).count(), 4)
+
+
+class SeatHoldTestCase(TestCase):
+    ''' Testcase class for holding seats while checking out '''
+
+    def setUp(self):
+        self.trip, self.schedule = create_trip(4)
+        self.user = CustomUserBase.objects.create(username='customer', first_name='Test', last_name='Customer')
+        self.other_user = CustomUserBase.objects.create(username='other', first_name='Other', last_name='Customer')
+
+    def call(self, view, body, user, method='post'):
+        ''' Calls the view as the given user and returns the json response '''
+        request = getattr(RequestFactory(), method)('/', json.dumps(body), content_type='application/json')
+        request.user = user
+        return json.loads(view(request).content)
+
+    def hold_seat(self, label, user):
+        ''' Holds the seat with the given label for the user '''
+        body = {'trip': self.trip.id, 'schedule': self.schedule.id, 'seat': label, 'bookedBy': str(user.unique_id)}
+        return self.call(hold, body, user)
+
+    def expire(self, hold_id):
+        ''' Moves the expiry of the hold into the past '''
+        Booking.objects.filter(id=hold_id).update(expires_on=django_timezone.now() - timedelta(seconds=1))
+
+    def test_hold_locks_seat(self):
+        ''' A held seat shows as locked and cannot be held or booked by someone else '''
+        held = self.hold_seat('A1', self.user)
+        self.assertIn('holdId', held)
+        self.assertEqual(get_seat_booking(self.trip, self.schedule)[0][1], {'state': 'locked'})
+        self.assertFalse(self.hold_seat('A1', self.other_user)['status'])
+        body = booking_json(self.trip, self.schedule, 'A1', self.other_user)
+        self.assertFalse(self.call(book, body, self.other_user)['status'])
+
+    def test_expired_hold_available(self):
+        ''' An expired hold is available on the seat map and can be taken over before the sweep '''
+        held = self.hold_seat('A1', self.user)
+        self.expire(held['holdId'])
+        self.assertEqual(get_seat_booking(self.trip, self.schedule)[0][1], {'state': 'available'})
+        body = booking_json(self.trip, self.schedule, 'A1', self.other_user)
+        self.assertIn('bookedingId', self.call(book, body, self.other_user))
+
+    def test_book_held_seat(self):
+        ''' Booking a seat the user holds turns the hold into a booking '''
+        held = self.hold_seat('A2', self.user)
+        body = booking_json(self.trip, self.schedule, 'A2', self.user)
+        self.assertEqual(self.call(book, body, self.user), {'bookedingId': held['holdId']})
+        booking = Booking.objects.get(id=held['holdId'])
+        self.assertEqual((booking.state, booking.expires_on, booking.passenger_name), ('booked', None, 'Passenger'))
+
+    def test_release_hold(self):
+        ''' A hold can be released by its user only '''
+        held = self.hold_seat('A3', self.user)
+        self.assertFalse(self.call(hold, {'hold': held['holdId']}, self.other_user, 'delete')['status'])
+        self.assertTrue(self.call(hold, {'hold': held['holdId']}, self.user, 'delete')['status'])
+        self.assertFalse(Booking.objects.exists())
+
+    def test_sweeper(self):
+        ''' The sweeper deletes expired holds, fixes the counts and leaves the rest alone '''
+        expired = self.hold_seat('A0', self.user)
+        self.hold_seat('A1', self.user)
+        book_seat(self.trip, self.schedule, 'A2')
+        self.expire(expired['holdId'])
+        out = StringIO()
+        with self.assertNumQueries(6):
+            call_command('release_expired_holds', stdout=out)
+        self.assertEqual(out.getvalue().splitlines(), ['Released 1 expired holds', 'Pruned 0 seat changes'])
+        self.assertEqual(sorted(Booking.objects.values_list('seat__label', flat=True)), ['A1', 'A2'])
+        inventory = TripInventory.objects.get(trip=self.trip, schedule=self.schedule)
+        self.assertEqual((inventory.booked, inventory.locked), (1, 1))
+
+    def test_sweeper_batches_trips(self):
+        ''' The expired holds of many trips are swept with the same number of queries as those of one '''
+        past = django_timezone.now() - timedelta(seconds=1)
+        trips = [create_trip(seat_count) for seat_count in range(2, 7)]
+        for trip, schedule in trips:
+            book_seat(trip, schedule, 'A0', state='locked', expires_on=past)
+            book_seat(trip, schedule, 'A1', state='locked', expires_on=past)
+        with self.assertNumQueries(6):
+            call_command('release_expired_holds', stdout=StringIO())
+        self.assertFalse(Booking.objects.exists())
+        self.assertEqual(set(TripInventory.objects.values_list('locked', 'version')), {(0, 3)})
+        self.assertEqual(SeatChange.objects.filter(version=3, state='available').count(), 10)
+
+    def test_release_twice(self):
+        ''' Releasing the same holds again leaves the locked count and the change log alone '''
+        self.expire(self.hold_seat('A0', self.user)['holdId'])
+        holds = expired_holds(trip=self.trip)
+        self.assertEqual(release_holds(holds), 1)
+        self.assertEqual(release_holds(holds), 0)
+        inventory = TripInventory.objects.get()
+        self.assertEqual((inventory.locked, inventory.version), (0, 2))
+        self.assertEqual(SeatChange.objects.filter(state='available').count(), 1)
+
+
+class BulkBookingTestCase(TestCase):
+    ''' Testcase class for booking several seats at once '''
+
+    def setUp(self):
+        self.trip, self.schedule = create_trip(10)
+        self.user = CustomUserBase.objects.create(username='agent', first_name='Test', last_name='Agent')
+
+    def book_seats(self, labels):
+        ''' Books the seats with the given labels in one request '''
+        body = booking_json(self.trip, self.schedule, None, self.user)
+        del body['seat']
+        body['seats'] = labels
+        request = RequestFactory().post('/api/v1/book/bulk/', json.dumps(body), content_type='application/json')
+        request.user = self.user
+        return json.loads(book_bulk(request).content)
+
+    def test_book_all(self):
+        ''' Every seat is booked and the ids come back in the order of the seats '''
+        response = self.book_seats(['A3', 'A1', 'A2'])
+        bookings = Booking.objects.in_bulk(response['bookingIds'])
+        self.assertEqual([bookings[booking_id].seat.label for booking_id in response['bookingIds']],
+                         ['A3', 'A1', 'A2'])
+
+    def test_book_none(self):
+        ''' A single taken seat leaves all of the seats unbooked '''
+        book_seat(self.trip, self.schedule, 'A2')
+        response = self.book_seats(['A1', 'A2', 'A3'])
+        self.assertEqual(response, {'status': False, 'error': 'Seats already booked by someone else: A2'})
+        self.assertEqual(Booking.objects.count(), 1)
+
+    def test_conflict_keeps_holds(self):
+        ''' A refused booking leaves the holds of the user and the counts as they were '''
+        held = book_seat(self.trip, self.schedule, 'A1', state='locked',
+                         expires_on=django_timezone.now() + timedelta(minutes=5))
+        Booking.objects.filter(id=held.id).update(booked_by=self.user)
+        book_seat(self.trip, self.schedule, 'A2')
+        self.assertFalse(self.book_seats(['A1', 'A2'])['status'])
+        self.assertTrue(Booking.objects.filter(id=held.id, state='locked').exists())
+        inventory = TripInventory.objects.get(trip=self.trip, schedule=self.schedule)
+        self.assertEqual((inventory.booked, inventory.locked), (1, 1))
+        self.assertEqual(len(self.book_seats(['A1', 'A3'])['bookingIds']), 2)
+        inventory.refresh_from_db()
+        self.assertEqual((inventory.booked, inventory.locked), (3, 0))
+
+    def test_invalid_seats(self):
+        ''' Unknown and repeated seats are rejected '''
+        self.assertEqual(self.book_seats(['A1', 'Z9', 'A1'])['error'], 'Invalid or repeated seats: A1, Z9')
+        self.assertFalse(Booking.objects.exists())
+
+    def test_constant_query_count(self):
+        ''' Booking more seats does not take more queries '''
+        self.book_seats(['A0'])
+        with self.assertNumQueries(14):
+            self.book_seats(['A1', 'A2'])
+        with self.assertNumQueries(14):
+            self.book_seats(['A3', 'A4', 'A5', 'A6', 'A7', 'A8', 'A9'])
+        self.assertEqual(Booking.objects.count(), 10)
+
+
+class ScheduleUpsertTestCase(TestCase):
+    ''' Testcase class for creating scheduled vehicles with many schedules '''
+
+    def setUp(self):
+        self.trip, self.schedule = create_trip(2)
+        self.route = self.schedule.route
+        self.other_route = Route.objects.create(source='Kathmandu', destination='Pokhara')
+
+    def post(self, body):
+        ''' Posts the scheduled vehicle json and returns the json response '''
+        body['vehicle'] = self.trip.vehicle.id
+        response = Client().post('/api/v1/scheduledvehicles/', json.dumps(body), content_type='application/json')
+        return response.json()
+
+    def recurrence(self, route, start, end, **spec):
+        ''' Returns a daily recurrence spec at 06:30 '''
+        return dict(route=route.id, time='06:30', nature='Day', start=start, end=end, **spec)
+
+    def test_reuses_existing_schedules(self):
+        ''' Posted schedules that already exist are linked instead of created again '''
+        body = {'schedule': [
+            {'route': self.route.id, 'date': '2019-11-16T08:15:00.000', 'time': '2019-11-16T08:15:00.000',
+             'nature': 'Day'},
+            {'route': self.other_route.id, 'date': '2019-11-17T08:15:00.000', 'time': '2019-11-17T18:15:00.000',
+             'nature': 'Night'},
+        ]}
+        self.assertEqual(self.post(body), {'success': 'Successfully created the vehicle schedule'})
+        scheduled_vehicle = ScheduledVehicle.objects.latest('id')
+        self.assertEqual(Schedule.objects.count(), 2)
+        self.assertIn(self.schedule, scheduled_vehicle.schedule.all())
+
+    def test_recurrence_query_count(self):
+        ''' A 90 day timetable takes the same number of queries as a 3 day one '''
+        with self.assertNumQueries(10):
+            self.post({'recurrence': [self.recurrence(self.route, '2026-11-01', '2026-11-03')]})
+        with self.assertNumQueries(10):
+            self.post({'recurrence': [self.recurrence(self.other_route, '2026-11-01', '2027-01-29')]})
+        self.assertEqual(ScheduledVehicle.objects.latest('id').schedule.count(), 90)
+        self.assertEqual(Schedule.objects.filter(route=self.other_route, time=time(6, 30)).count(), 90)
+
+    def test_recurrence_weekdays(self):
+        ''' Only the listed weekdays get a schedule '''
+        self.post({'recurrence': [self.recurrence(self.route, '2026-11-02', '2026-11-15', weekdays=[0, 4])]})
+        dates = ScheduledVehicle.objects.latest('id').schedule.order_by('date').values_list('date', flat=True)
+        self.assertEqual(list(dates), [date(2026, 11, 2), date(2026, 11, 6), date(2026, 11, 9), date(2026, 11, 13)])
+
+    def test_invalid_recurrence(self):
+        ''' Recurrences ending before they start or spanning too long are rejected '''
+        response = self.post({'recurrence': [self.recurrence(self.route, '2026-11-02', '2026-11-01')]})
+        self.assertEqual(response['error'],
+                         'ScheduleRecurrenceException: Recurring schedule cannot end before it starts.')
+        response = self.post({'recurrence': [self.recurrence(self.route, '2026-01-01', '2027-12-31')]})
+        self.assertIn('more than 366 days', response['error'])
+
+    def test_malformed_body(self):
+        ''' A null schedule list or weekdays that are not a list get an error instead of a 500 '''
+        self.assertEqual(self.post({'schedule': None})['error'], "TypeError: 'NoneType' object is not iterable")
+        response = self.post({'recurrence': [self.recurrence(self.route, '2026-11-01', '2026-11-03', weekdays=2)]})
+        self.assertEqual(response['error'], "TypeError: 'int' object is not iterable")
+        self.assertEqual(ScheduledVehicle.objects.count(), 1)
+
+    def test_unknown_route(self):
+        ''' An unknown route leaves neither schedules nor a scheduled vehicle behind '''
+        recurrence = self.recurrence(self.route, '2026-11-01', '2026-11-03')
+        response = self.post({'recurrence': [recurrence, {**recurrence, 'route': 999}]})
+        self.assertEqual(response['error'], 'DoesNotExist: Route matching query does not exist: [999]')
+        self.assertEqual(ScheduledVehicle.objects.count(), 1)
+        self.assertEqual(Schedule.objects.count(), 1)
+
+
+class DatetimeParsingTestCase(TestCase):
+    ''' Testcase class for parsing datetime strings '''
+
+    def test_iso_format(self):
+        ''' The format sent by the apps is parsed into an aware datetime '''
+        self.assertEqual(parse_datetime_str('2019-11-16T18:15:00.000'),
+                         datetime(2019, 11, 16, 18, 15, tzinfo=timezone.utc))
+        self.assertEqual(parse_datetime_str('2019-11-16T18:15:00.000Z'),
+                         datetime(2019, 11, 16, 18, 15, tzinfo=timezone.utc))
+        self.assertEqual(parse_datetime_str('2019-11-16T18:15:00+05:45'),
+                         datetime(2019, 11, 16, 12, 30, tzinfo=timezone.utc))
+
+    def test_dateutil_fallback(self):
+        ''' Other formats still go through dateutil '''
+        self.assertEqual(parse_datetime_str('Nov 16 2019 6:15 PM'),
+                         datetime(2019, 11, 16, 18, 15, tzinfo=timezone.utc))
+        self.assertEqual(parse_datetime_str('06:30').time(), time(6, 30))
+        with self.assertRaises(ValueError):
+            parse_datetime_str('not a date')
+
+
+class BookingHistoryTestCase(TestCase):
+    ''' Testcase class for listing the bookings of a user '''
+
+    def setUp(self):
+        self.user = CustomUserBase.objects.create(username='agent', first_name='Test', last_name='Agent')
+        self.client = Client()
+        self.client.force_login(self.user)
+        self.trip, self.schedule = create_trip(40)
+        today = date.today()
+        self.schedules = [Schedule.objects.create(route=self.schedule.route, date=today + timedelta(days=day),
+                                                  time=time(6, 30), nature='Day') for day in (2, 0, 1)]
+
+    def book(self, count, start=0):
+        ''' Books count seats spread over the upcoming schedules '''
+        for index in range(start, start + count):
+            booking = book_seat(self.trip, self.schedules[index % 3], f'A{index}')
+            booking.booked_by = self.user
+            booking.save()
+
+    def test_query_budget(self):
+        ''' Listing more bookings does not take more queries '''
+        self.book(3)
+        with CaptureQueriesContext(connection) as context:
+            self.client.get('/api/v1/book/')
+        self.book(37, start=3)
+        with self.assertNumQueries(len(context.captured_queries)):
+            response = self.client.get('/api/v1/book/?limit=100')
+        self.assertEqual(len(response.json()['bookedSeats']), 40)
+        self.assertEqual(response.json()['bookedSeats'][0]['trip']['vehicleNumberPlate'], 'BA 40')
+
+    def test_pages(self):
+        ''' Following the cursors walks every booking once in (date, id) order '''
+        self.book(25)
+        seen = []
+        url = '/api/v1/book/?limit=10'
+        while url:
+            data = self.client.get(url).json()
+            self.assertLessEqual(len(data['bookedSeats']), 10)
+            seen.extend(booking['id'] for booking in data['bookedSeats'])
+            url = data['next'] and f'/api/v1/book/?limit=10&cursor={data["next"]}'
+        expected = Booking.objects.order_by('schedule__date', 'id').values_list('id', flat=True)
+        self.assertEqual(seen, list(expected))
+
+    def test_invalid_cursor(self):
+        ''' A broken cursor gets an error back '''
+        self.assertEqual(self.client.get('/api/v1/book/?cursor=abc').json(),
+                         {'error': 'PaginationException: Invalid cursor.'})
+
+
+class StreamingListTestCase(TestCase):
+    ''' Testcase class for streaming the catalog lists '''
+
+    def test_same_body(self):
+        ''' The streamed lists carry the same json as the buffered ones '''
+        create_trip(3)
+        create_trip(5)
+        client = Client()
+        for url in ('/api/v1/layouts/', '/api/v1/routes/', '/api/v1/vehicletypes/', '/api/v1/vehicles/',
+                    '/api/v1/schedule/'):
+            response = client.get(url + '?stream=1')
+            self.assertTrue(response.streaming)
+            streamed = json.loads(b''.join(response.streaming_content))
+            self.assertEqual(streamed, client.get(url).json())
+
+    def test_prefetch_per_chunk(self):
+        ''' The streamed scheduled vehicles get their schedules prefetched instead of a query per row '''
+        for seat_count in range(2, 6):
+            create_trip(seat_count)
+        client = Client()
+        with self.assertNumQueries(3):
+            response = client.get('/api/v1/scheduledvehicles/?stream=1')
+            streamed = json.loads(b''.join(response.streaming_content))
+        self.assertEqual(streamed, client.get('/api/v1/scheduledvehicles/').json())
+        response = stream_json_list('scheduledVehicles', ScheduledVehicle.objects.prefetch_related('schedule__route'),
+                                    lambda trip: [schedule.route.source for schedule in trip.schedule.all()], 3)
+        with self.assertNumQueries(1 + 2 * 2):
+            self.assertEqual(len(json.loads(b''.join(response.streaming_content))['scheduledVehicles']), 4)
+
+    def test_stream_off(self):
+        ''' ?stream=0 gets the buffered list '''
+        create_trip(3)
+        self.assertFalse(Client().get('/api/v1/routes/?stream=0').streaming)
+
+
+class ListPaginationTestCase(TestCase):
+    ''' Testcase class for paging through the list views '''
+
+    def setUp(self):
+        self.client = Client()
+        self.trip, self.schedule = create_trip(2)
+
+    def walk(self, url, key, limit):
+        ''' Follows the next cursors from the first page and returns the ids of every row '''
+        ids = []
+        page_url = f'{url}?limit={limit}'
+        while page_url:
+            data = self.client.get(page_url).json()
+            self.assertLessEqual(len(data[key]), limit)
+            ids.extend(row['id'] for row in data[key])
+            page_url = data['next'] and f'{url}?limit={limit}&cursor={data["next"]}'
+        return ids
+
+    def test_schedule_pages(self):
+        ''' Schedules come page by page in date and time order '''
+        for day in (3, 1, 2):
+            for hour in (18, 6):
+                Schedule.objects.create(route=self.schedule.route, date=date(2019, 12, day), time=time(hour),
+                                        nature='Day')
+        expected = list(Schedule.objects.order_by('date', 'time', 'id').values_list('id', flat=True))
+        self.assertEqual(self.walk('/api/v1/schedule/', 'schedule', 2), expected)
+
+    def test_id_ordered_pages(self):
+        ''' The other lists come page by page in id order '''
+        for index in range(4):
+            create_trip(index + 3)
+        for url, key in (('/api/v1/routes/', 'routes'), ('/api/v1/layouts/', 'layouts'),
+                         ('/api/v1/vehicles/', 'vehicles'), ('/api/v1/vehicletypes/', 'vehicleTypes'),
+                         ('/api/v1/scheduledvehicles/', 'scheduledVehicles')):
+            expected = sorted(row['id'] for row in self.client.get(url).json()[key])
+            self.assertEqual(self.walk(url, key, 2), expected)
+
+    def test_page_size_cap(self):
+        ''' Asking for more than the cap gets a capped page '''
+        route = self.schedule.route
+        Schedule.objects.bulk_create(Schedule(route=route, date=date(2019, 12, 1), time=time(6, minute % 60),
+                                              nature='Day') for minute in range(MAX_PAGE_SIZE + 5))
+        data = self.client.get('/api/v1/schedule/?limit=100000').json()
+        self.assertEqual(len(data['schedule']), MAX_PAGE_SIZE)
+        self.assertIsNotNone(data['next'])
+        self.assertEqual(self.client.get('/api/v1/routes/?limit=many').json(),
+                         {'error': 'PaginationException: Limit must be a number.'})
+
+
+class CatalogConditionTestCase(TestCase):
+    ''' Testcase class for conditional GETs of the catalog '''
+
+    def setUp(self):
+        self.client = Client()
+        create_trip(4)
+
+    def test_not_modified(self):
+        ''' A matching If-None-Match gets a 304 after only reading the version stamps '''
+        for url in ('/api/v1/layouts/', '/api/v1/routes/', '/api/v1/vehicletypes/', '/api/v1/vehicles/'):
+            response = self.client.get(url)
+            self.assertTrue(response.has_header('Last-Modified'))
+            with self.assertNumQueries(1):
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertEqual(response.status_code, 304)
+
+    def test_write_changes_etag(self):
+        ''' Writing to a table changes the ETag of the lists built from it '''
+        etags = {url: self.client.get(url)['ETag'] for url in ('/api/v1/routes/', '/api/v1/vehicles/')}
+        Route.objects.create(source='Butwal', destination='Pokhara')
+        self.assertNotEqual(self.client.get('/api/v1/routes/')['ETag'], etags['/api/v1/routes/'])
+        self.assertEqual(self.client.get('/api/v1/vehicles/')['ETag'], etags['/api/v1/vehicles/'])
+        Seat.objects.create(layout=Layout.objects.first(), label='B1', row=3, col=0)
+        self.assertNotEqual(self.client.get('/api/v1/vehicles/')['ETag'], etags['/api/v1/vehicles/'])
+
+    def test_query_string_changes_etag(self):
+        ''' Pages and the whole list have their own ETags '''
+        self.assertNotEqual(self.client.get('/api/v1/routes/')['ETag'],
+                            self.client.get('/api/v1/routes/?limit=1')['ETag'])
+
+
+class SearchAvailabilityTestCase(TestCase):
+    ''' Testcase class for the seat counts in search results '''
+
+    def test_seat_counts(self):
+        ''' Booked and held seats are taken off while expired holds are not '''
+        small_trip, schedule = create_trip(4)
+        big_trip, big_schedule = create_trip(10)
+        big_trip.schedule.add(schedule)
+        other_schedule = Schedule.objects.create(route=schedule.route, date=date(2019, 11, 16), time=time(20),
+                                                 nature='Night')
+        small_trip.schedule.add(other_schedule)
+        book_seat(small_trip, schedule, 'A0')
+        book_seat(small_trip, schedule, 'A1', state='locked')
+        book_seat(small_trip, other_schedule, 'A2')
+        book_seat(big_trip, schedule, 'A3', state='locked', expires_on=django_timezone.now() - timedelta(minutes=1))
+        book_seat(big_trip, schedule, 'A4')
+        body = json.dumps({'route': schedule.route.id, 'date': '2019-11-16T08:15:00.000'})
+        with self.assertNumQueries(3):
+            response = Client().post('/api/v1/search/', body, content_type='application/json')
+        counts = [(row['id'], row['schedule']['id'], row['totalSeats'], row['availableSeats'])
+                  for row in response.json()['scheduledVehicles']]
+        self.assertEqual(counts, [(small_trip.id, schedule.id, 4, 2), (big_trip.id, schedule.id, 10, 9),
+                                  (big_trip.id, big_schedule.id, 10, 10),
+                                  (small_trip.id, other_schedule.id, 4, 3)])
+        call_command('release_expired_holds', stdout=StringIO())
+        response = Client().post('/api/v1/search/', body, content_type='application/json')
+        self.assertEqual(response.json()['scheduledVehicles'][1]['availableSeats'], 9)
+
+    def test_without_inventory(self):
+        ''' Trips booked before the inventory existed get their bookings counted '''
+        trip, schedule = create_trip(4)
+        book_seat(trip, schedule, 'A0')
+        book_seat(trip, schedule, 'A1', state='locked', expires_on=django_timezone.now() - timedelta(minutes=1))
+        TripInventory.objects.all().delete()
+        body = json.dumps({'route': schedule.route.id, 'date': '2019-11-16T08:15:00.000'})
+        response = Client().post('/api/v1/search/', body, content_type='application/json')
+        self.assertEqual(response.json()['scheduledVehicles'][0]['availableSeats'], 3)
+
+
+class TripInventoryTestCase(TestCase):
+    ''' Testcase class for the per trip seat counts '''
+
+    def setUp(self):
+        self.trip, self.schedule = create_trip(4)
+        self.user = CustomUserBase.objects.create(username='customer', first_name='Test', last_name='Customer')
+
+    def test_counts_follow_writes(self):
+        ''' Bookings and holds move the counts and the first read counts the trip from scratch '''
+        book_seat(self.trip, self.schedule, 'A0')
+        TripInventory.objects.all().delete()
+        inventory = get_inventory(self.trip.id, self.schedule.id)
+        self.assertEqual((inventory.total, inventory.booked, inventory.locked), (4, 1, 0))
+        request = RequestFactory().post('/', json.dumps(booking_json(self.trip, self.schedule, 'A1', self.user)),
+                                        content_type='application/json')
+        request.user = self.user
+        self.assertIn('bookedingId', json.loads(book(request).content))
+        inventory.refresh_from_db()
+        self.assertEqual((inventory.booked, inventory.available), (2, 2))
+
+    def test_sold_out(self):
+        ''' A full trip turns bookings away before touching the seats '''
+        for label in ('A0', 'A1', 'A2', 'A3'):
+            book_seat(self.trip, self.schedule, label)
+        self.assertTrue(get_inventory(self.trip.id, self.schedule.id).sold_out)
+        request = RequestFactory().post('/', json.dumps(booking_json(self.trip, self.schedule, 'A0', self.user)),
+                                        content_type='application/json')
+        request.user = self.user
+        self.assertEqual(json.loads(book(request).content)['error'], 'This trip is sold out.')
+
+    def test_reconcile(self):
+        ''' The reconcile command reports drifted counts and fixes them '''
+        book_seat(self.trip, self.schedule, 'A0')
+        book_seat(self.trip, self.schedule, 'A1', state='locked',
+                  expires_on=django_timezone.now() + timedelta(minutes=5))
+        TripInventory.objects.update(booked=3, locked=0)
+        out = StringIO()
+        call_command('reconcile_inventory', '--dry-run', stdout=out)
+        self.assertIn('1 inventories drifted', out.getvalue())
+        self.assertEqual(TripInventory.objects.get().booked, 3)
+        call_command('reconcile_inventory', stdout=out)
+        inventory = TripInventory.objects.get()
+        self.assertEqual((inventory.total, inventory.booked, inventory.locked), (4, 1, 1))
+        out = StringIO()
+        call_command('reconcile_inventory', stdout=out)
+        self.assertIn('0 inventories drifted', out.getvalue())
+
+
+class SeatMapChangesTestCase(TestCase):
+    ''' Testcase class for the versioned seat map changes '''
+
+    def setUp(self):
+        self.trip, self.schedule = create_trip(6, columns=3)
+        self.user = CustomUserBase.objects.create(username='customer', first_name='Test', last_name='Customer')
+        self.url = f'/api/v1/scheduledvehicles/{self.trip.id}/{self.schedule.id}/'
+
+    def call(self, view, body, method='post'):
+        ''' Calls the view as the user and returns the json response '''
+        request = getattr(RequestFactory(), method)('/', json.dumps(body), content_type='application/json')
+        request.user = self.user
+        return json.loads(view(request).content)
+
+    def test_changes_since_version(self):
+        ''' Only the seats changed after the given version come back, the latest state of each '''
+        version = Client().get(self.url).json()['version']
+        self.assertEqual(version, 0)
+        self.assertEqual(Client().get(f'{self.url}?since=0').status_code, 304)
+        self.call(book, booking_json(self.trip, self.schedule, 'A1', self.user))
+        held = self.call(hold, {'trip': self.trip.id, 'schedule': self.schedule.id, 'seat': 'A4',
+                                'bookedBy': str(self.user.unique_id)})
+        with self.assertNumQueries(5):
+            response = Client().get(f'{self.url}?since=0').json()
+        self.assertEqual(response['version'], 2)
+        self.assertEqual([(change['row'], change['col']) for change in response['changes']], [(0, 1), (1, 1)])
+        self.assertEqual(response['changes'][1]['state'], 'locked')
+        self.call(hold, {'hold': held['holdId']}, 'delete')
+        response = Client().get(f'{self.url}?since=1').json()
+        self.assertEqual(response, {'version': 3, 'changes': [{'row': 1, 'col': 1, 'state': 'available'}]})
+        self.assertEqual(Client().get(f'{self.url}?since=3').status_code, 304)
+
+    def test_expired_hold_is_a_change(self):
+        ''' A hold running out moves the version at once, without waiting for the sweeper '''
+        held = self.call(hold, {'trip': self.trip.id, 'schedule': self.schedule.id, 'seat': 'A4',
+                                'bookedBy': str(self.user.unique_id)})
+        self.assertEqual(Client().get(f'{self.url}?since=1').status_code, 304)
+        Booking.objects.filter(id=held['holdId']).update(expires_on=django_timezone.now() - timedelta(seconds=1))
+        response = Client().get(f'{self.url}?since=1').json()
+        self.assertEqual(response, {'version': 2, 'changes': [{'row': 1, 'col': 1, 'state': 'available'}]})
+        self.assertEqual(Client().get(self.url).json()['booked_seats'][1][1], {'state': 'available'})
+        self.assertEqual(TripInventory.objects.get().locked, 0)
+
+    def test_stale_version(self):
+        ''' A version the server has not reached yet gets the full seat map '''
+        response = Client().get(f'{self.url}?since=9').json()
+        self.assertEqual(response['version'], 0)
+        self.assertEqual(len(response['booked_seats']), 2)
+        self.assertIn('error', Client().get(f'{self.url}?since=latest').json())
+
+    @override_settings(SEAT_CHANGE_VERSIONS=2)
+    def test_pruned_changes(self):
+        ''' The sweeper prunes changes the kept versions do not need, older versions get the full seat map '''
+        for label in ('A0', 'A1', 'A2', 'A3'):
+            self.call(book, booking_json(self.trip, self.schedule, label, self.user))
+        out = StringIO()
+        call_command('release_expired_holds', stdout=out)
+        self.assertIn('Pruned 2 seat changes', out.getvalue())
+        self.assertEqual(sorted(SeatChange.objects.values_list('version', flat=True)), [3, 4])
+        response = Client().get(f'{self.url}?since=2').json()
+        self.assertEqual([change['col'] for change in response['changes']], [2, 0])
+        response = Client().get(f'{self.url}?since=1').json()
+        self.assertEqual((response['version'], len(response['booked_seats'])), (4, 2))
+
+    def test_unknown_trip(self):
+        ''' A version of a trip or schedule that does not exist gets the error of the full seat map '''
+        response = Client().get(f'/api/v1/scheduledvehicles/{self.trip.id + 1}/{self.schedule.id}/?since=0')
+        self.assertEqual(response.json(), {'error': 'DoesNotExist: ScheduledVehicle matching query does not exist.'})
+        response = Client().get(f'/api/v1/scheduledvehicles/{self.trip.id}/{self.schedule.id + 1}/?since=0')
+        self.assertEqual(response.json(), {'error': 'DoesNotExist: Schedule matching query does not exist.'})
+
+    @override_settings(SEAT_MAP_MAX_WAIT=1, SEAT_MAP_POLL_SECONDS=0.01)
+    def test_wait_times_out(self):
+        ''' A long poll without changes ends in a 304 after the timeout '''
+        response = Client().get(f'{self.url}?since=0&wait=0.05')
+        self.assertEqual(response.status_code, 304)
+
+    def test_wait_off_by_default(self):
+        ''' Without SEAT_MAP_MAX_WAIT the seat map answers at once whatever the wait '''
+        with self.assertNumQueries(3):
+            response = Client().get(f'{self.url}?since=0&wait=30')
+        self.assertEqual(response.status_code, 304)
+
+
+class CompactGridTestCase(TestCase):
+    ''' Testcase class for the compact layout and seat map format '''
+
+    def setUp(self):
+        layout_grid_cache.clear()
+        self.trip, self.schedule = create_trip(7, columns=4)
+        self.layout = self.trip.vehicle.vehicle_type.layout
+
+    def test_compact_layout(self):
+        ''' The compact layout carries the same seats as the full grid '''
+        compact = get_compact_layout_json(self.layout.id)
+        self.assertEqual(compact, {'id': self.layout.id, 'name': 'Layout 7', 'rows': 2, 'cols': 4, 'active': [15, 7],
+                                   'labels': ['A0', 'A1', 'A2', 'A3', 'A4', 'A5', 'A6']})
+        grid = layout_to_json(self.layout)['data']
+        self.assertEqual([[cell['is_active'] for cell in row] for row in grid],
+                         [[bool(bits >> col & 1) for col in range(compact['cols'])] for bits in compact['active']])
+        version = layout_version()
+        with self.assertNumQueries(0):
+            get_compact_layout_json(self.layout.id, version=version)
+        Seat.objects.create(layout=self.layout, label='C3', row=2, col=3)
+        self.assertEqual(get_compact_layout_json(self.layout.id)['active'], [15, 7, 8])
+
+    def test_compact_layout_list(self):
+        ''' The layout list switches format on ?format=compact or the Accept header, with its own ETag '''
+        full = self.client.get('/api/v1/layouts/')
+        compact = self.client.get('/api/v1/layouts/', HTTP_ACCEPT=COMPACT_MEDIA_TYPE)
+        self.assertIn('data', full.json()['layouts'][0])
+        self.assertEqual(compact.json()['layouts'][0]['active'], [15, 7])
+        self.assertEqual(self.client.get('/api/v1/layouts/?format=compact').json(), compact.json())
+        self.assertNotEqual(full['ETag'], compact['ETag'])
+        self.assertIn('Accept', compact['Vary'])
+
+    def test_compact_seat_map(self):
+        ''' The compact seat map has one state character per seat '''
+        book_seat(self.trip, self.schedule, 'A1')
+        book_seat(self.trip, self.schedule, 'A5', state='locked')
+        book_seat(self.trip, self.schedule, 'A6', state='locked ')
+        self.assertEqual(get_seat_booking(self.trip, self.schedule, compact=True),
+                         {'rows': 2, 'cols': 4, 'active': [15, 7], 'states': 'abaaall'})
+        response = self.client.get(f'/api/v1/scheduledvehicles/{self.trip.id}/{self.schedule.id}/?format=compact')
+        self.assertEqual(response.json()['booked_seats']['states'], 'abaaall')
+        layout = response.json()['scheduledVehicle']['vehicle']['vehicleType']['layout']
+        self.assertEqual(layout, get_compact_layout_json(self.layout.id))
+
+    def test_compact_changes(self):
+        ''' The changes since a version index into the states of the compact seat map '''
+        url = f'/api/v1/scheduledvehicles/{self.trip.id}/{self.schedule.id}/'
+        book_seat(self.trip, self.schedule, 'A1')
+        seat = Seat.objects.get(layout=self.layout, label='A5')
+        adjust_inventory(self.trip.id, self.schedule.id, booked=1, seats={seat.id: 'booked'})
+        response = self.client.get(f'{url}?since=1', HTTP_ACCEPT=COMPACT_MEDIA_TYPE)
+        self.assertEqual(response.json(), {'version': 2, 'changes': [[5, 'b']]})
+        self.assertIn('Accept', response['Vary'])
+        self.assertEqual(self.client.get(f'{url}?since=1&format=compact').json(), response.json())
+        self.assertEqual(self.client.get(f'{url}?since=2&format=compact')['Vary'], 'Accept')
+
+
+class BulkSeatMapTestCase(TestCase):
+    ''' Testcase class for getting many seat maps in one request '''
+
+    def setUp(self):
+        self.trip, self.schedule = create_trip(4)
+        self.other_trip, self.other_schedule = create_trip(3)
+        # a second bus of the same vehicle shares the layout of the first
+        self.twin_trip = ScheduledVehicle.objects.create(vehicle=self.trip.vehicle)
+        self.twin_trip.schedule.add(self.schedule)
+        book_seat(self.trip, self.schedule, 'A0')
+        book_seat(self.twin_trip, self.schedule, 'A3')
+        book_seat(self.other_trip, self.other_schedule, 'A1', state='locked')
+
+    def seat_maps(self, pairs, query=''):
+        ''' Posts the pairs to the bulk seat map view '''
+        body = json.dumps({'trips': [{'trip': trip, 'schedule': schedule} for trip, schedule in pairs]})
+        return self.client.post(f'/api/v1/seatmaps/{query}', body, content_type='application/json').json()
+
+    def test_same_as_single_seat_maps(self):
+        ''' Every seat map matches the single trip one, in the order asked '''
+        pairs = [(self.twin_trip, self.schedule), (self.other_trip, self.other_schedule), (self.trip, self.schedule)]
+        seat_maps = self.seat_maps([(trip.id, schedule.id) for trip, schedule in pairs])['seatMaps']
+        self.assertEqual([seat_map['booked_seats'] for seat_map in seat_maps],
+                         [get_seat_booking(trip, schedule) for trip, schedule in pairs])
+        self.assertEqual([(seat_map['trip'], seat_map['version']) for seat_map in seat_maps],
+                         [(self.twin_trip.id, 1), (self.other_trip.id, 1), (self.trip.id, 1)])
+        compact = self.seat_maps([(self.trip.id, self.schedule.id)], '?format=compact')['seatMaps'][0]
+        self.assertEqual(compact['booked_seats']['states'], 'baaa')
+
+    def test_constant_query_count(self):
+        ''' Asking for more trips does not take more queries '''
+        with self.assertNumQueries(4):
+            self.seat_maps([(self.trip.id, self.schedule.id)])
+        with self.assertNumQueries(4):
+            seat_maps = self.seat_maps([(self.trip.id, self.schedule.id), (self.twin_trip.id, self.schedule.id),
+                                        (self.other_trip.id, self.other_schedule.id),
+                                        (self.other_trip.id, self.schedule.id)])['seatMaps']
+        self.assertEqual(['error' in seat_map for seat_map in seat_maps], [False, False, False, True])
+
+    def test_errors(self):
+        ''' Pairs with no such trip running on the schedule get an error each, too many fail the request '''
+        seat_maps = self.seat_maps([(0, self.schedule.id), (self.trip.id, 0), (self.other_trip.id, self.schedule.id),
+                                    (self.trip.id, self.schedule.id)])['seatMaps']
+        self.assertEqual([seat_map.get('error') for seat_map in seat_maps[:3]],
+                         ['DoesNotExist: ScheduledVehicle matching query does not exist.'] * 3)
+        self.assertNotIn('booked_seats', seat_maps[2])
+        self.assertEqual(len(seat_maps[3]['booked_seats']), 1)
+        self.assertFalse(self.seat_maps([(self.trip.id, self.schedule.id)] * 101)['status'])
+        self.assertIn('error', self.client.post('/api/v1/seatmaps/', '{"trips": [{}]}',
+                                                content_type='application/json').json())
+
+
+class QueryPlanAuditTestCase(TestCase):
+    ''' Testcase class for the query plan audit command '''
+
+    def test_hot_queries_use_indexes(self):
+        ''' None of the hot queries scans a whole table '''
+        out = StringIO()
+        call_command('audit_query_plans', verbosity=2, stdout=out)
+        self.assertNotIn('full scan', out.getvalue())
+
+    def test_full_scan_found(self):
+        ''' A filter on a column without an index shows up as a full scan '''
+        self.assertEqual(full_scans(Booking.objects.filter(passenger_name='Passenger')), ['apiv1_booking'])
+
+
+class BenchmarkCommandsTestCase(TestCase):
+    ''' Testcase class for the fleet seeder and the endpoint benchmark '''
+
+    def test_seed_and_benchmark(self):
+        ''' A small seeded network gets every endpoint benchmarked without errors '''
+        out = StringIO()
+        call_command('seed_fleet', routes=2, layouts=2, vehicles=3, days=2, fill=0.25, start=date(2030, 1, 1),
+                     stdout=out)
+        self.assertEqual(out.getvalue().strip(),
+                         'Seeded 2 routes, 2 layouts, 3 vehicles, 8 schedules and 50 bookings')
+        self.assertEqual(get_inventory(*Booking.objects.values_list('trip_id', 'schedule_id').first()).booked, 8)
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'benchmark.json')
+            err = StringIO()
+            call_command('benchmark_endpoints', iterations=2, warmup=0, output=output, stdout=StringIO(), stderr=err)
+            with open(output) as output_file:
+                results = json.load(output_file)
+        self.assertEqual(err.getvalue(), '')
+        self.assertEqual(results['bookings'], 50)
+        self.assertEqual([(result['name'], result['status'], result.get('error')) for result in results['endpoints']
+                          if result['status'] != 200 or 'error' in result], [])
+        self.assertTrue(all(result['queries'] > 0 for result in results['endpoints']))
+
+
+class SQLInstrumentationTestCase(TestCase):
+    ''' Testcase class for the SQL instrumentation middleware '''
+
+    def setUp(self):
+        self.trip, _ = create_trip(2)
+        for day in range(2, 9):
+            self.trip.schedule.add(Schedule.objects.create(route=Route.objects.get(), date=date(2019, 11, day),
+                                                           time=time(8, 15), nature='Day'))
+
+    @override_settings(SQL_INSTRUMENTATION=True)
+    def test_repeated_queries_flagged(self):
+        ''' The scheduled vehicle detail looks up the route of every schedule and gets flagged '''
+        with self.assertLogs('yatri_bus.sql', 'INFO') as logs:
+            response = Client().get(f'/api/v1/scheduledvehicles/{self.trip.id}/')
+        self.assertRegex(response['Server-Timing'], r'^sql;dur=[\d.]+;desc="\d+ queries", view;dur=[\d.]+$')
+        line = json.loads(logs.records[0].getMessage())
+        self.assertEqual((line['view'], line['status']), ('apiv1.views.scheduled_vehicles', 200))
+        warnings = [record.getMessage() for record in logs.records if record.levelname == 'WARNING']
+        self.assertEqual(len(warnings), 1)
+        self.assertIn('apiv1.views.scheduled_vehicles ran the same query 8 times: SELECT', warnings[0])
+        self.assertIn('"apiv1_route"', warnings[0])
+
+    def test_in_lists_share_a_shape(self):
+        ''' Lookups with IN lists of different lengths have the same shape '''
+        self.assertEqual(query_shape('SELECT * FROM "apiv1_seat" WHERE "id" IN (%s, %s, %s) AND "row" = %s'),
+                         query_shape('SELECT * FROM "apiv1_seat" WHERE "id" IN (%s, %s) AND "row" = %s'))
+
+    def test_off_by_default(self):
+        ''' Without SQL_INSTRUMENTATION the middleware is left out '''
+        self.assertNotIn('Server-Timing', Client().get('/api/v1/routes/'))
+
+    def test_info_lines_logged(self):
+        ''' The logging settings send the info lines of the SQL log to the console '''
+        self.assertTrue(logging.getLogger('yatri_bus.sql').isEnabledFor(logging.INFO))
+        self.assertTrue([handler for handler in logging.getLogger('yatri_bus').handlers
+                         if isinstance(handler, logging.StreamHandler)])
+
+
+class MetricsTestCase(TestCase):
+    ''' Testcase class for the request and booking metrics '''
+
+    def test_processes_summed(self):
+        ''' Samples written by two processes are added up in the exposition '''
+        with tempfile.TemporaryDirectory() as directory:
+            registries = [metrics.Registry(directory, flush_seconds=0, process_id=pid) for pid in (1, 2)]
+            for registry in registries:
+                registry.counter('test_total', 'Test counter', ('result',)).inc(result='success')
+                registry.histogram('test_seconds', 'Test histogram', buckets=(0.1, 1)).observe(0.5)
+            registries[1].metrics[0].inc(2, result='conflict')
+            text = registries[0].exposition()
+        self.assertIn('# TYPE test_total counter\ntest_total{result="conflict"} 2\ntest_total{result="success"} 2\n',
+                      text)
+        self.assertIn('test_seconds_bucket{le="1"} 2\ntest_seconds_bucket{le="+Inf"} 2\n'
+                      'test_seconds_count 2\ntest_seconds_sum 1\n', text)
+        self.assertNotIn('le="0.1"', text)
+
+    def test_exited_process_folded(self):
+        ''' The samples of an exited process are kept and a process reusing its id starts from zero '''
+        with tempfile.TemporaryDirectory() as directory:
+            scraper = metrics.Registry(directory, flush_seconds=0, process_id=1)
+            exiting = metrics.Registry(directory, flush_seconds=0, process_id=2)
+            exiting.counter('test_total', 'Test counter').inc(3)
+            scraper.fold(2)
+            scraper.fold(2)
+            self.assertEqual(sorted(os.listdir(directory)), ['.lock', 'metrics-exited.json'])
+            metrics.Registry(directory, flush_seconds=0, process_id=2).counter('test_total', 'Test counter').inc()
+            self.assertEqual(scraper.collect(), {('test_total', ()): 4})
+            scraper.reset()
+            self.assertEqual(scraper.collect(), {})
+
+    def test_idle_process_flushed(self):
+        ''' Samples taken right after a flush are written once the interval is over without a new sample '''
+        with tempfile.TemporaryDirectory() as directory:
+            registry = metrics.Registry(directory, flush_seconds=0.05, process_id=1)
+            counter = registry.counter('test_total', 'Test counter')
+            counter.inc()
+            counter.inc()
+            registry._timer.join()
+            self.assertEqual(metrics.read_samples(registry.path()), {('test_total', ()): 2})
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_metrics_endpoint(self):
+        ''' Requests are counted by url name and bookings by result '''
+        trip, schedule = create_trip(2)
+        user = CustomUserBase.objects.create(username='customer', first_name='Test', last_name='Customer')
+        before = dict(metrics.registry.samples)
+        Client().get('/api/v1/routes/')
+        for _ in range(2):
+            request = RequestFactory().post('/', json.dumps(booking_json(trip, schedule, 'A0', user)),
+                                            content_type='application/json')
+            request.user = user
+            book(request)
+        response = Client().get('/metrics', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        self.assertIn('yatri_http_requests_total{view="routes",status="200"}', response.content.decode())
+
+        def added(name, **labels):
+            key = (name, tuple((label, str(value)) for label, value in labels.items()))
+            return metrics.registry.samples.get(key, 0) - before.get(key, 0)
+        self.assertEqual(added('yatri_bookings_total', result='success'), 1)
+        self.assertEqual(added('yatri_bookings_total', result='conflict'), 1)
+        self.assertEqual(added('yatri_http_request_duration_seconds_count', view='routes'), 1)
+
+    def test_metrics_need_token(self):
+        ''' The metrics are not found without a token set and forbidden without the right one '''
+        self.assertEqual(Client().get('/metrics').status_code, 404)
+        with override_settings(METRICS_TOKEN='secret'):
+            self.assertEqual(Client().get('/metrics').status_code, 403)
+            self.assertEqual(Client().get('/metrics', HTTP_AUTHORIZATION='Bearer other').status_code, 403)
+
+
+class ProfilingTestCase(TestCase):
+    ''' Testcase class for the sampling profiler and its report '''
+
+    def test_sampled_profiles_rotated_and_reported(self):
+        ''' Every sampled request leaves a profile, the oldest go and the report merges the rest '''
+        with tempfile.TemporaryDirectory() as directory:
+            with override_settings(PROFILE_DIR=directory, PROFILE_SAMPLE_RATE=1, PROFILE_KEEP=2):
+                client = Client()
+                for path in ('/api/v1/routes/', '/api/v1/layouts/', '/api/v1/routes/'):
+                    client.get(path)
+            names = sorted(os.listdir(directory))
+            self.assertEqual([name.split('-')[2] for name in names], ['layouts', 'routes'])
+            out = StringIO()
+            call_command('profile_report', dir=directory, top=5, stdout=out)
+            self.assertRegex(out.getvalue(), r'routes\s+1\s+[\d.]+\s+\d+')
+            self.assertIn('function calls', out.getvalue())
+            out = StringIO()
+            call_command('profile_report', dir=directory, view='layouts', stdout=out)
+            self.assertNotIn('routes', out.getvalue().split('\n\n')[0])
+
+    def test_profile_on_header(self):
+        ''' With the header allowed only the requests asking for it are profiled '''
+        with tempfile.TemporaryDirectory() as directory:
+            with override_settings(PROFILE_DIR=directory, PROFILE_ALLOW_HEADER=True):
+                client = Client()
+                self.assertNotIn('X-Profile', client.get('/api/v1/routes/'))
+                response = client.get('/api/v1/routes/', HTTP_X_PROFILE='1')
+            self.assertEqual(os.listdir(directory), [response['X-Profile']])
+
+
+@override_settings(REPLICA_DATABASE='replica')
+class ReplicaRoutingTestCase(TestCase):
+    ''' Testcase class for sending the reads of read only views to the replica '''
+
+    def call(self, method, path, write=False, cookies=None):
+        ''' Runs a request through the routing middleware, returns where Route and user reads went and the response '''
+        reads = []
+
+        def view(request):
+            middleware.process_view(request, None, (), {})
+            reads.append(router.db_for_read(Route))
+            if write:
+                router.db_for_write(Booking)
+                reads.append(router.db_for_read(Route))
+            reads.append(router.db_for_read(CustomUserBase))
+            return JsonResponse({})
+        router = ReplicaRouter()
+        middleware = ReplicaRoutingMiddleware(view)
+        request = getattr(RequestFactory(), method)(path)
+        request.resolver_match = resolve(path)
+        request.COOKIES.update(cookies or {})
+        return reads, middleware(request)
+
+    def test_read_only_views_use_replica(self):
+        ''' Catalog lists and search read apiv1 models from the replica, users stay on the primary '''
+        self.assertEqual(self.call('get', '/api/v1/routes/')[0], ['replica', None])
+        self.assertEqual(self.call('post', '/api/v1/search/')[0], ['replica', None])
+        self.assertEqual(self.call('post', '/api/v1/book/')[0], [None, None])
+        self.assertEqual(self.call('post', '/api/v1/routes/')[0], [None, None])
+
+    def test_seat_maps_on_primary(self):
+        ''' Seat maps, their change feed and the booking history are read from the primary '''
+        self.assertEqual(self.call('get', '/api/v1/scheduledvehicles/1/')[0], ['replica', None])
+        self.assertEqual(self.call('get', '/api/v1/scheduledvehicles/1/2/')[0], [None, None])
+        self.assertEqual(self.call('post', '/api/v1/seatmaps/')[0], [None, None])
+        self.assertEqual(self.call('get', '/api/v1/book/')[0], [None, None])
+
+    def test_sticky_primary_after_write(self):
+        ''' A write moves the rest of the request and the next ones of the client to the primary '''
+        reads, response = self.call('post', '/api/v1/book/', write=True)
+        self.assertEqual(reads, [None, None, None])
+        cookie = response.cookies[ReplicaRoutingMiddleware.cookie]
+        self.assertEqual(cookie['max-age'], 10)
+        reads, response = self.call('get', '/api/v1/routes/', cookies={cookie.key: cookie.value})
+        self.assertEqual(reads, [None, None])
+        self.assertNotIn(cookie.key, response.cookies)
+        stale = {cookie.key: str(django_timezone.now().timestamp() - 1)}
+        self.assertEqual(self.call('get', '/api/v1/routes/', cookies=stale)[0], ['replica', None])
+        self.assertEqual(self.call('get', '/api/v1/routes/', cookies={cookie.key: 'x'})[0], ['replica', None])
+
+    def test_outside_requests(self):
+        ''' Reads outside a request, like those of management commands, go to the primary '''
+        self.call('get', '/api/v1/routes/')
+        self.assertIsNone(ReplicaRouter().db_for_read(Route))
+
+
+@skipUnless('replica' in settings.DATABASES, 'needs REPLICA_DATABASE_URL, a second sqlite file works')
+class ReplicaDatabaseTestCase(TransactionTestCase):
+    ''' Testcase class for reading from a real second database '''
+    databases = {'default', 'replica'}
+
+    def test_reads_from_replica(self):
+        ''' Routes written to the primary show up for the writer at once and for others once replicated '''
+        writer = Client()
+        body = json.dumps({'source': 'Pokhara', 'destination': 'Kathmandu'})
+        writer.post('/api/v1/routes/', body, content_type='application/json')
+        self.assertEqual(len(writer.get('/api/v1/routes/').json()['routes']), 1)
+        self.assertEqual(Client().get('/api/v1/routes/').json()['routes'], [])
+        route = Route.objects.get()
+        Route.objects.using('replica').bulk_create([route])
+        self.assertEqual(len(Client().get('/api/v1/routes/').json()['routes']), 1)
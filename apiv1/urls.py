@@ -11,8 +11,11 @@ urlpatterns = [
     path('schedule/',views.schedule, name='schedule'),
     path('scheduledvehicles/', views.scheduled_vehicles, name='vehicle_items'),
     path('scheduledvehicles/<int:v_id>/', views.scheduled_vehicles, name='vehicle_items'),
-    path('scheduledvehicles/<int:v_id>/<int:s_id>/', views.scheduled_vehicles, name='vehicle_items'),
+    path('scheduledvehicles/<int:v_id>/<int:s_id>/', views.scheduled_vehicles, name='seat_map'),
+    path('seatmaps/', views.seat_maps, name='SeatMaps'),
     path('search/', views.search, name="Search"),
-    path('book/', views.book, name="Booking")
+    path('book/', views.book, name="Booking"),
+    path('book/bulk/', views.book_bulk, name="BulkBooking"),
+    path('hold/', views.hold, name="Hold"),
     # path('book/<int:booked_id>/', views.book, name="Booking") #for future use if needed
 ]
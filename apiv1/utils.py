@@ -1,9 +1,34 @@
 ''' Utility module '''
+import datetime
+import functools
+import hashlib
+import itertools
+import json
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, transaction
+from django.db.models import Count, F, IntegerField, OuterRef, Subquery, prefetch_related_objects
+from django.db.models.functions import Coalesce
 from django.forms.models import model_to_dict as django_model_to_dict
+from django.http import JsonResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.views.decorators.http import condition
 import dateutil.parser
-# import dateutil.parser
-from .models import Layout, Seat, Booking
-from .exceptions import LayoutJsonFormatException
+from .models import Layout, Seat, Booking, Route, Schedule, ScheduledVehicle, CatalogVersion, TripInventory
+from .cache import layout_grid_cache
+from .exceptions import LayoutJsonFormatException, ScheduleRecurrenceException, PaginationException
+from .pagination import is_paginated, paginate
+
+# rows read from the database at a time by streaming responses
+STREAM_CHUNK_SIZE = 500
+# longest span of days a recurring schedule can be generated for in one go
+MAX_RECURRENCE_DAYS = 366
+# media type that asks for the compact grid format, as does ?format=compact
+COMPACT_MEDIA_TYPE = 'application/vnd.yatri.compact+json'
+# one character per seat in the states string of a compact seat map
+SEAT_STATE_CODES = {'available': 'a', 'booked': 'b', 'locked': 'l', 'unavailable': 'u'}
+# most seat maps one bulk request may ask for
+MAX_SEAT_MAPS = 100
 
 
 def model_to_dict(class_name):
@@ -15,15 +40,97 @@ def model_to_dict(class_name):
     return object_list
 
 
+def stream_json_list(key, queryset, serialize, chunk_size=STREAM_CHUNK_SIZE):
+    '''
+    Returns a streaming response of {key: [...]} that serializes the objects of the queryset
+    one at a time while they are read in chunks, so the whole list is never held in memory.
+    The prefetch_related lookups of the queryset are done for each chunk, as iterator()
+    leaves them out.
+    '''
+    def generate():
+        yield '{' + json.dumps(key) + ': ['
+        objects = queryset.iterator(chunk_size=chunk_size)
+        separator = ''
+        for chunk in iter(lambda: list(itertools.islice(objects, chunk_size)), []):
+            prefetch_related_objects(chunk, *queryset._prefetch_related_lookups)
+            for obj in chunk:
+                yield separator + json.dumps(serialize(obj), cls=DjangoJSONEncoder)
+                separator = ', '
+        yield ']}'
+    return StreamingHttpResponse(generate(), content_type='application/json')
+
+
+def list_response(request, key, queryset, serialize, ordering=('id',)):
+    '''
+    Returns the response of a list view as {key: [...]}. Requests with a limit or a cursor get
+    a page of the list keyset paginated on ordering along with the next cursor, ?stream=1
+    streams the whole list and anything else gets the whole list at once.
+    '''
+    if is_paginated(request):
+        try:
+            page, next_cursor = paginate(queryset, request, ordering)
+        except PaginationException as exp:
+            return JsonResponse({'error': f'{exp.__class__.__name__}: {exp}'})
+        return JsonResponse({key: [serialize(obj) for obj in page], 'next': next_cursor})
+    if request.GET.get('stream') == '1':
+        return stream_json_list(key, queryset, serialize)
+    return JsonResponse({key: [serialize(obj) for obj in queryset]})
+
+
+def catalog_condition(*names):
+    '''
+    Decorator for views listing catalog tables, GETs get a strong ETag and a Last-Modified
+    header out of the versions of the named tables and are answered with a 304 when the
+    client already has them, without reading the tables themselves
+    '''
+    def versions(request):
+        if not hasattr(request, '_catalog_versions'):
+            request._catalog_versions = list(CatalogVersion.objects.filter(name__in=names).order_by('name'))
+        return request._catalog_versions
+
+    def etag(request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return None
+        stamp = ','.join(f'{version.name}:{version.version}' for version in versions(request))
+        digest = hashlib.md5(
+            f'{request.get_full_path()}|{wants_compact(request)}|{stamp}'.encode('utf-8')).hexdigest()
+        return f'"{digest}"'
+
+    def last_modified(request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return None
+        return max((version.modified_on for version in versions(request)), default=None)
+
+    return condition(etag_func=etag, last_modified_func=last_modified)
+
+
+def wants_compact(request):
+    ''' Tells whether the request asked for the compact grid format '''
+    return request.GET.get('format') == 'compact' or COMPACT_MEDIA_TYPE in request.META.get('HTTP_ACCEPT', '')
+
+
+def compact_grid(cells):
+    '''
+    Takes in (row, col) cells and gives the grid size along with a bitset of every row,
+    bit c of a row is set when its column c holds a seat
+    '''
+    if not cells:
+        return {'rows': 0, 'cols': 0, 'active': []}
+    active = [0] * (max(row for row, _ in cells) + 1)
+    for row, col in cells:
+        active[row] |= 1 << col
+    return {'rows': len(active), 'cols': max(col for _, col in cells) + 1, 'active': active}
+
+
 def layout_to_json(layout):
     ''' Takes in layout objects and gives all the data related to layout and it's seats'''
-    seats = Seat.objects.filter(layout=layout)
+    seats = list(Seat.objects.filter(layout=layout))
     response_json = {
         'id': layout.id,
         'name': layout.name,
         'data': [],
     }
-    if seats.count() == 0:
+    if not seats:
         return response_json
     position_x = []
     position_y = []
@@ -47,24 +154,197 @@ def layout_to_json(layout):
     return response_json
 
 
-def json_to_layout(data):
-    ''' takes in the layout grid and creates seats with layout with it '''
+def layout_version():
+    ''' Returns the version stamp of the layouts, the layout grid cache is keyed on it '''
+    return CatalogVersion.objects.filter(name='layout').values_list('version', flat=True).first() or 0
+
+
+def get_layout_json(layout_id, layout=None, version=None):
+    '''
+    Cached version of layout_to_json, the layout object is only needed (and fetched when
+    not given) on a cache miss. Pass the layout_version() when serializing many layouts so
+    that it is read once.
+    '''
+    return layout_grid_cache.get(
+        layout_id, lambda: layout_to_json(layout or Layout.objects.get(id=layout_id)),
+        layout_version() if version is None else version)
+
+
+def layout_to_compact(layout):
+    '''
+    Compact form of layout_to_json, the grid as row bitsets and the labels of the seats in
+    row major order
+    '''
+    seats = list(Seat.objects.filter(layout=layout).order_by('row', 'col').values_list('row', 'col', 'label'))
+    response_json = {'id': layout.id, 'name': layout.name}
+    response_json.update(compact_grid([(row, col) for row, col, _ in seats]))
+    response_json['labels'] = [label for _, _, label in seats]
+    return response_json
+
+
+def get_compact_layout_json(layout_id, layout=None, version=None):
+    ''' Cached version of layout_to_compact '''
+    return layout_grid_cache.get(
+        layout_id, lambda: layout_to_compact(layout or Layout.objects.get(id=layout_id)),
+        layout_version() if version is None else version, kind='compact')
+
+
+def layout_cells(data):
+    '''
+    Validates the layout json and returns its name and the (row, col, label) of the active
+    cells of its grid
+    '''
     layout_name = data['name']
     layout_data = data['data']
     if layout_name == "":
         raise LayoutJsonFormatException("Layout name is needed to create a layout")
-    layout = Layout.objects.create(name=str(layout_name))
+    max_label = Seat._meta.get_field('label').max_length
+    cells = []
     for x_index, row in enumerate(layout_data):
         for y_index, cell in enumerate(row):
             if cell['is_active']:
-                temp_seat = Seat(layout=layout, col=y_index, row=x_index)
-                temp_seat.label = cell['label']
-                temp_seat.save()
+                if cell['label'] is not None and len(str(cell['label'])) > max_label:
+                    raise LayoutJsonFormatException(
+                        f"Seat label {cell['label']} is longer than {max_label} characters")
+                cells.append((x_index, y_index, cell['label']))
+    return str(layout_name), cells
+
+
+def json_to_layout(data):
+    ''' takes in the layout grid and creates seats with layout with it '''
+    layout_name, cells = layout_cells(data)
+    with transaction.atomic():
+        layout = Layout.objects.create(name=layout_name)
+        Seat.objects.bulk_create([Seat(layout=layout, row=row, col=col, label=label) for row, col, label in cells])
+    layout_grid_cache.invalidate(layout.id)
     return layout
 
-def datetime_str_to_object(date_str):
-    ''' Parses datetime string to datetime object '''
-    return dateutil.parser.parse(date_str)
+
+def json_to_layouts(data_list):
+    '''
+    Batch version of json_to_layout. Valid layouts are created together, invalid ones are
+    skipped. Returns a list with the id of the created layout or the error for each item.
+    '''
+    results = []
+    valid_items = []
+    for data in data_list:
+        try:
+            layout_name, cells = layout_cells(data)
+            valid_items.append((Layout(name=Layout.normalize_name(layout_name)), cells))
+            results.append(valid_items[-1][0])
+        except (KeyError, TypeError, LayoutJsonFormatException) as exp:
+            results.append({'error': f'{exp.__class__.__name__}: {exp}'})
+    with transaction.atomic():
+        if connection.features.can_return_ids_from_bulk_insert:
+            Layout.objects.bulk_create([layout for layout, _ in valid_items])
+        else:
+            last_id = Layout.objects.order_by('-id').values_list('id', flat=True).first() or 0
+            Layout.objects.bulk_create([layout for layout, _ in valid_items])
+            # the new rows come back in insert order, matched up by name in case others were added alongside
+            new_ids = {}
+            for layout_id, name in Layout.objects.filter(
+                    id__gt=last_id, name__in={layout.name for layout, _ in valid_items}).order_by('id').values_list(
+                        'id', 'name'):
+                new_ids.setdefault(name, []).append(layout_id)
+            for layout, _ in valid_items:
+                layout.id = new_ids[layout.name].pop(0)
+        seats = []
+        for layout, cells in valid_items:
+            seats.extend(Seat(layout=layout, row=row, col=col, label=label) for row, col, label in cells)
+        Seat.objects.bulk_create(seats)
+        CatalogVersion.bump('layout')
+    layout_grid_cache.invalidate(*[layout.id for layout, _ in valid_items])
+    return [{'id': result.id} if isinstance(result, Layout) else result for result in results]
+
+def parse_datetime_str(date_str):
+    '''
+    Parses datetime string to datetime object. The ISO 8601 strings sent by the apps are
+    parsed with datetime.fromisoformat, anything else falls back to dateutil. Naive results
+    are made aware in the default timezone when USE_TZ is on.
+    '''
+    try:
+        parsed = datetime.datetime.fromisoformat(
+            date_str[:-1] + '+00:00' if date_str.endswith('Z') else date_str)
+    except (AttributeError, ValueError):
+        parsed = dateutil.parser.parse(date_str)
+    if settings.USE_TZ and timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed, timezone.get_default_timezone())
+    return parsed
+
+
+# the same few timestamps are parsed over and over within a request, datetimes are immutable
+datetime_str_to_object = functools.lru_cache(maxsize=256)(parse_datetime_str)
+
+def schedule_json_to_entry(schedule_json):
+    ''' Returns the (route id, date, time, nature) of a schedule json '''
+    return (
+        int(schedule_json['route']),
+        datetime_str_to_object(schedule_json['date']).date(),
+        datetime_str_to_object(schedule_json['time']).time(),
+        str(schedule_json['nature'])
+    )
+
+
+def expand_recurrence(spec):
+    '''
+    Returns the (route id, date, time, nature) of every schedule of a recurring schedule
+    {
+        "route": 3,
+        "time": "06:30",
+        "nature": "Day",
+        "start": "2026-11-01",
+        "end": "2027-01-31",
+        "weekdays": [0, 2, 4]
+    }
+    weekdays are optional (0 is monday), the schedule runs daily without them
+    '''
+    route_id = int(spec['route'])
+    start = datetime_str_to_object(spec['start']).date()
+    end = datetime_str_to_object(spec['end']).date()
+    departure = datetime_str_to_object(spec['time']).time()
+    nature = str(spec['nature'])
+    weekdays = {int(day) for day in spec.get('weekdays', range(7))}
+    days = (end - start).days + 1
+    if days < 1:
+        raise ScheduleRecurrenceException('Recurring schedule cannot end before it starts.')
+    if days > MAX_RECURRENCE_DAYS:
+        raise ScheduleRecurrenceException(f'Recurring schedule cannot span more than {MAX_RECURRENCE_DAYS} days.')
+    dates = (start + datetime.timedelta(days=offset) for offset in range(days))
+    return [(route_id, day, departure, nature) for day in dates if day.weekday() in weekdays]
+
+
+def get_or_create_schedules(entries):
+    '''
+    Takes in (route id, date, time, nature) tuples and returns the matching schedules in the
+    same order, the missing ones are created with a single insert
+    '''
+    if not entries:
+        return []
+    routes = Route.objects.in_bulk({entry[0] for entry in entries})
+    missing_routes = {entry[0] for entry in entries} - set(routes)
+    if missing_routes:
+        raise Route.DoesNotExist(f'Route matching query does not exist: {sorted(missing_routes)}')
+
+    def existing_schedules():
+        schedules = Schedule.objects.filter(
+            route_id__in=routes,
+            date__range=(min(entry[1] for entry in entries), max(entry[1] for entry in entries))
+        )
+        return {(schedule.route_id, schedule.date, schedule.time, schedule.nature): schedule
+                for schedule in schedules}
+
+    schedules = existing_schedules()
+    new_schedules = [Schedule(route=routes[entry[0]], date=entry[1], time=entry[2], nature=entry[3])
+                     for entry in dict.fromkeys(entries) if entry not in schedules]
+    if new_schedules:
+        Schedule.objects.bulk_create(new_schedules)
+        if connection.features.can_return_ids_from_bulk_insert:
+            schedules.update({(schedule.route_id, schedule.date, schedule.time, schedule.nature): schedule
+                              for schedule in new_schedules})
+        else:
+            schedules = existing_schedules()
+    return [schedules[entry] for entry in entries]
+
 
 def create_booking_instances(scheduled_vehicle):
     ''' Function to initilze all the booking (seats) for the schedule vehicles'''
@@ -74,35 +354,147 @@ def create_booking_instances(scheduled_vehicle):
         Booking.objects.create(seat=seat, trip=scheduled_vehicle)
 
 
-def get_seat_booking(trip, schedule):
-    ''' Takes in layout objects and gives all the data related to layout and it's seats'''
-    seats = Seat.objects.filter(layout=trip.vehicle.vehicle_type.layout)
-    response_json = []
-    if seats.count() == 0:
-        return response_json
-    position_x = []
-    position_y = []
-    states = []
-    for seat in seats:
-        position_x.append(int(seat.row))
-        position_y.append(int(seat.col))
-        try:
-            state = Booking.objects.get(seat=seat, trip=trip, schedule=schedule).state
-        except Booking.DoesNotExist:
-            state = 'available'
-        states.append(str(state))
-    for temp_x in range(max(position_x)+1):
-        response_json.append([])
-        for _ in range(max(position_y)+1):
-            response_json[temp_x].append(
-                {
-                    'state': "none"
-                }
-            )
-    for index, state in enumerate(states):
-        response_json[position_x[index]][position_y[index]]['state'] = state
+def expired_holds(**filters):
+    ''' Returns the locked bookings whose hold has run out '''
+    return Booking.objects.filter(state='locked', expires_on__lte=timezone.now(), **filters)
+
+
+def seat_states(trip, schedule):
+    '''
+    Returns a dict of seat id to booking state for the given trip and schedule, expired
+    holds are left out so those seats show up as available
+    '''
+    bookings = live_bookings(trip=trip, schedule=schedule).values_list('seat_id', 'state')
+    return {seat_id: str(state) for seat_id, state in bookings}
+
+
+def live_bookings(**filters):
+    ''' Returns the bookings matching the filters, leaving out holds that have expired '''
+    return Booking.objects.filter(**filters).exclude(state='locked', expires_on__lte=timezone.now())
+
+
+def trips_with_availability(schedule_ids):
+    '''
+    Returns the scheduled vehicle to schedule links of the given schedules annotated with the
+    seat count of the vehicle as total_seats and the seats booked or held on that schedule as
+    booked_seats, for every link at once. booked_seats is read off the trip inventory less
+    the holds that have expired but are not swept yet, trips without an inventory get their
+    live bookings counted instead.
+    '''
+    now = timezone.now()
+    seat_count = Seat.objects.filter(
+        layout=OuterRef('scheduledvehicle__vehicle__vehicle_type__layout')
+    ).order_by().values('layout').annotate(count=Count('id')).values('count')
+    taken_count = TripInventory.objects.filter(
+        trip=OuterRef('scheduledvehicle'), schedule=OuterRef('schedule')
+    ).annotate(taken=F('booked') + F('locked')).values('taken')
+    expired_count = Booking.objects.filter(
+        trip=OuterRef('scheduledvehicle'), schedule=OuterRef('schedule'), state='locked', expires_on__lte=now
+    ).order_by().values('trip').annotate(count=Count('id')).values('count')
+    booking_count = Booking.objects.filter(
+        trip=OuterRef('scheduledvehicle'), schedule=OuterRef('schedule')
+    ).exclude(
+        state='locked', expires_on__lte=now
+    ).order_by().values('trip').annotate(count=Count('id')).values('count')
+    return ScheduledVehicle.schedule.through.objects.filter(schedule_id__in=schedule_ids).select_related(
+        'scheduledvehicle__vehicle__vehicle_type'
+    ).annotate(
+        total_seats=Coalesce(Subquery(seat_count, output_field=IntegerField()), 0),
+        booked_seats=Coalesce(
+            Subquery(taken_count, output_field=IntegerField())
+            - Coalesce(Subquery(expired_count, output_field=IntegerField()), 0),
+            Subquery(booking_count, output_field=IntegerField()),
+            0,
+        ),
+    ).order_by('scheduledvehicle_id')
+
+
+def seat_state_grid(seats, states):
+    '''
+    Builds the seat map grid out of (id, row, col) seat tuples and a dict of seat id to
+    state, seats missing in the dict are available
+    '''
+    if not seats:
+        return []
+    rows = max(seat[1] for seat in seats) + 1
+    cols = max(seat[2] for seat in seats) + 1
+    grid = [[{'state': "none"} for _ in range(cols)] for _ in range(rows)]
+    for seat_id, row, col in seats:
+        grid[row][col]['state'] = states.get(seat_id, 'available')
+    return grid
+
+
+def compact_seat_states(seats, states):
+    '''
+    Compact form of seat_state_grid for (id, row, col) seat tuples in row major order, the
+    grid as row bitsets and one SEAT_STATE_CODES character per seat
+    '''
+    response_json = compact_grid([(row, col) for _, row, col in seats])
+    response_json['states'] = ''.join(SEAT_STATE_CODES.get(states.get(seat_id, 'available').strip(), '?')
+                                      for seat_id, _, _ in seats)
     return response_json
 
+
+def get_seat_booking(trip, schedule, compact=False):
+    '''
+    Takes in trip and schedule objects and gives the booking state of every seat in its layout,
+    in the compact format when asked to
+    '''
+    seats = list(Seat.objects.filter(
+        layout__vehicletype__vehicle__scheduledvehicle=trip
+    ).order_by('row', 'col').values_list('id', 'row', 'col'))
+    if compact:
+        return compact_seat_states(seats, seat_states(trip, schedule) if seats else {})
+    if not seats:
+        return []
+    return seat_state_grid(seats, seat_states(trip, schedule))
+
+def get_seat_bookings(pairs, compact=False):
+    '''
+    Bulk version of get_seat_booking for a list of (trip id, schedule id) pairs. The seats of
+    every distinct layout are fetched once and the bookings of all the trips with one IN
+    query. Gives a seat map with its version for each pair in order, or an error for pairs
+    whose trip does not exist or does not run on the schedule.
+    '''
+    asked = set(pairs)
+    layouts = {}
+    for trip_id, schedule_id, layout_id in ScheduledVehicle.schedule.through.objects.filter(
+            scheduledvehicle_id__in={trip_id for trip_id, _ in asked},
+            schedule_id__in={schedule_id for _, schedule_id in asked}).values_list(
+                'scheduledvehicle_id', 'schedule_id', 'scheduledvehicle__vehicle__vehicle_type__layout_id'):
+        if (trip_id, schedule_id) in asked:
+            layouts[(trip_id, schedule_id)] = layout_id
+    seats = {}
+    for layout_id, seat_id, row, col in Seat.objects.filter(layout_id__in=set(layouts.values())).order_by(
+            'layout_id', 'row', 'col').values_list('layout_id', 'id', 'row', 'col'):
+        seats.setdefault(layout_id, []).append((seat_id, row, col))
+    trip_ids = {trip_id for trip_id, _ in layouts}
+    schedule_ids = {schedule_id for _, schedule_id in layouts}
+    # read before the bookings so that a change in between is sent again rather than missed
+    versions = {(trip_id, schedule_id): version for trip_id, schedule_id, version in TripInventory.objects.filter(
+        trip_id__in=trip_ids, schedule_id__in=schedule_ids).values_list('trip_id', 'schedule_id', 'version')}
+    states = {}
+    bookings = live_bookings(trip_id__in=trip_ids, schedule_id__in=schedule_ids).values_list(
+        'trip_id', 'schedule_id', 'seat_id', 'state')
+    for trip_id, schedule_id, seat_id, state in bookings:
+        states.setdefault((trip_id, schedule_id), {})[seat_id] = str(state)
+    response = []
+    for trip_id, schedule_id in pairs:
+        if (trip_id, schedule_id) not in layouts:
+            response.append({'trip': trip_id, 'schedule': schedule_id,
+                             'error': 'DoesNotExist: ScheduledVehicle matching query does not exist.'})
+            continue
+        layout_seats = seats.get(layouts[(trip_id, schedule_id)], [])
+        trip_states = states.get((trip_id, schedule_id), {})
+        if compact:
+            seat_map = compact_seat_states(layout_seats, trip_states)
+        else:
+            seat_map = seat_state_grid(layout_seats, trip_states)
+        response.append({'trip': trip_id, 'schedule': schedule_id, 'version': versions.get((trip_id, schedule_id), 0),
+                         'booked_seats': seat_map})
+    return response
+
+
 def datetime_obj_to_str(datetime_obj):
     '''Converts datetime object to approprite string format'''
     my_date = datetime_obj.strftime('%Y-%m-%dT%H:%M:%S.')
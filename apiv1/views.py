@@ -1,20 +1,37 @@
 ''' Views module of api '''
 import json
 import datetime
-from django.http import JsonResponse
+from django.conf import settings
+from django.http import JsonResponse, HttpResponseNotModified
+from django.utils import timezone
 from django.views.decorators.http import require_http_methods
+from django.views.decorators.vary import vary_on_headers
 
 from .models import Layout, Route, Seat, VehicleType, Vehicle, ScheduledVehicle, Schedule, Booking
-from .serializers import RouteSerializer, VehicleTypeSerializer, VehicleSerializer, ScheduledVehicleSerializer, ScheduleSerializer
-from .utils import layout_to_json, json_to_layout, datetime_str_to_object, create_booking_instances, get_seat_booking, booking_to_json
-from .exceptions import LayoutJsonFormatException, RouteValueException, EmptyValueException
-from django.db import IntegrityError
+from .serializers import RouteSerializer, VehicleTypeSerializer, VehicleSerializer, ScheduledVehicleSerializer, \
+    ScheduleSerializer, ScheduledVehicleSummarySerializer
+from .utils import get_layout_json, json_to_layout, json_to_layouts, datetime_str_to_object, \
+    create_booking_instances, get_seat_booking, booking_to_json, expired_holds, schedule_json_to_entry, \
+    expand_recurrence, get_or_create_schedules, list_response, catalog_condition, trips_with_availability, \
+    wants_compact, get_compact_layout_json, get_seat_bookings, MAX_SEAT_MAPS, layout_version
+from .exceptions import LayoutJsonFormatException, RouteValueException, EmptyValueException, \
+    ScheduleRecurrenceException, PaginationException
+from .pagination import paginate
+from .inventory import adjust_inventory, get_inventory, release_holds, inventory_version, wait_for_change, seat_changes
+from django.db import IntegrityError, transaction
 from users.models import CustomUserBase
+from yatri_bus import metrics
 from django.db.models import Q
 
 @require_http_methods(['GET', 'POST'])
+@vary_on_headers('Accept')
+@catalog_condition('layout')
 def layouts(request):
-    ''' View for handling tasks related to layout model
+    ''' View for handling tasks related to layout model, post a list of layouts to create them in bulk,
+    get with ?stream=1 to stream the list
+    or with ?limit= to page through it, ?format=compact (or an Accept of COMPACT_MEDIA_TYPE) gives
+    every layout as {"id": 1, "name": "Test Layout two", "rows": 3, "cols": 6, "active": [63, 1, 63],
+    "labels": ["a", "b", ...]} where bit c of a row in active is set when column c holds a seat
     {
         "name": "Test Layout two",
         "data": [
@@ -48,21 +65,24 @@ def layouts(request):
     if request.method == "POST":
         try:
             request_json = json.loads(request.body.decode('utf-8'))
+            if isinstance(request_json, list):
+                return JsonResponse({'layouts': json_to_layouts(request_json)})
             json_to_layout(request_json)
             return JsonResponse({'success': 'Successfully created the layout'})
-        except (KeyError, json.decoder.JSONDecodeError, LayoutJsonFormatException) as exp:
+        except (KeyError, TypeError, json.decoder.JSONDecodeError, LayoutJsonFormatException) as exp:
             return JsonResponse({'error': f'{exp.__class__.__name__}: {exp}'})
-    response = []
-    layout_objects = Layout.objects.all()
-    for layout in layout_objects:
-        response.append(layout_to_json(layout))
-    return JsonResponse({'layouts': response})
+    layout_json = get_compact_layout_json if wants_compact(request) else get_layout_json
+    version = layout_version()
+    return list_response(request, 'layouts', Layout.objects.all(),
+                         lambda layout: layout_json(layout.id, layout, version))
 
 
 @require_http_methods(['GET', 'POST'])
+@catalog_condition('route')
 def routes(request):
     '''
-    View for handling tasks related to route model
+    View for handling tasks related to route model, get with ?stream=1 to stream the list
+    or with ?limit= to page through it
     {
         "source":"Kathmandu",
         "destination":"Pisd"
@@ -76,16 +96,14 @@ def routes(request):
         except (KeyError, json.decoder.JSONDecodeError, EmptyValueException, RouteValueException,
                 IntegrityError) as exp:
             return JsonResponse({'error': f'{exp.__class__.__name__}: {exp}'})
-    response = []
-    route_objects = Route.objects.all()
-    for route in route_objects:
-        response.append(RouteSerializer(route).data)
-    return JsonResponse({'routes': response})
+    return list_response(request, 'routes', Route.objects.all(), lambda route: RouteSerializer(route).data)
 
 @require_http_methods(['GET', 'POST'])
+@catalog_condition('vehicletype', 'layout')
 def vehicle_types(request):
     '''
-    View for handling tasks related to vehicle_type model
+    View for handling tasks related to vehicle_type model, get with ?stream=1 to stream the list
+    or with ?limit= to page through it
     Example json for post is:
     {
      "name": "TestVehicleType one",
@@ -100,22 +118,25 @@ def vehicle_types(request):
             return JsonResponse({'success': 'Successfully created the vehicle type'})
         except (KeyError, json.decoder.JSONDecodeError, Layout.DoesNotExist) as exp:
             return JsonResponse({'error': f'{exp.__class__.__name__}: {exp}'})
-    response = []
-    vehicle_type_objects = VehicleType.objects.all()
-    for vehicle_type in vehicle_type_objects:
-        response.append(VehicleTypeSerializer(vehicle_type).data)
-    return JsonResponse({'vehicleTypes': response})
+    context = {'layout_version': layout_version()}
+    return list_response(request, 'vehicleTypes', VehicleType.objects.all(),
+                         lambda vehicle_type: VehicleTypeSerializer(vehicle_type, context=context).data)
 
 def schedule(request):
-    response = []
-    for schedule_object in Schedule.objects.all():
-        response.append(ScheduleSerializer(schedule_object).data)
-    return JsonResponse({'schedule':response})
+    '''
+    View for listing the schedules, pass ?stream=1 to stream the list or ?limit= to get it a
+    page at a time in (date, time) order, the next cursor of a page goes in ?cursor=
+    '''
+    return list_response(request, 'schedule', Schedule.objects.select_related('route'),
+                         lambda schedule_object: ScheduleSerializer(schedule_object).data,
+                         ordering=('date', 'time', 'id'))
 
 @require_http_methods(['GET', 'POST'])
+@catalog_condition('vehicle', 'vehicletype', 'layout')
 def vehicles(request):
     '''
-    View for handling tasks related to vehicle model
+    View for handling tasks related to vehicle model, get with ?stream=1 to stream the list
+    or with ?limit= to page through it
     Example json for post is:
     {
      "vehicleType": 1,
@@ -130,16 +151,16 @@ def vehicles(request):
             return JsonResponse({'success': 'Successfully created the vehicle'})
         except (KeyError, json.decoder.JSONDecodeError, VehicleType.DoesNotExist) as exp:
             return JsonResponse({'error': f'{exp.__class__.__name__}: {exp}'})
-    response = []
-    vehicle_objects = Vehicle.objects.all()
-    for vehicle in vehicle_objects:
-        response.append(VehicleSerializer(vehicle).data)
-    return JsonResponse({'vehicles': response})
+    context = {'layout_version': layout_version()}
+    return list_response(request, 'vehicles', Vehicle.objects.select_related('vehicle_type'),
+                         lambda vehicle: VehicleSerializer(vehicle, context=context).data)
 
 @require_http_methods(['GET', 'POST'])
+@vary_on_headers('Accept')
 def scheduled_vehicles(request, v_id=None, s_id=None):
     '''
-    View for handling tasks related to vehicle_item model
+    View for handling tasks related to vehicle_item model, the list can be limited to some
+    fields with ?fields=id,vehicle and paged with ?limit= and ?cursor=
     request format:
     {
         "vehicle": 1,
@@ -163,64 +184,116 @@ def scheduled_vehicles(request, v_id=None, s_id=None):
                 "time": "2019-11-16T18:15:00.000",
                 "nature":"Night",
             },
+        ],
+        "recurrence":
+        [
+            {
+                "route":1,
+                "time": "06:30",
+                "nature":"Day",
+                "start": "2019-11-16",
+                "end": "2020-02-13",
+                "weekdays": [0, 2, 4]
+            }
         ]
     }
+    schedule entries are looked up or created in bulk, recurrence generates a schedule for
+    every day (or every listed weekday, 0 is monday) from start to end
+
+    The seat map of a trip on a schedule comes with its version, pass it back as ?since= to get
+    only the seats changed after it ({"version": 7, "changes": [{"row":0, "col":1, "state":"booked"}]})
+    or a 304 when nothing changed, the full seat map when it is more than SEAT_CHANGE_VERSIONS
+    behind. ?wait=<seconds> holds the request until a change or the timeout,
+    at most SEAT_MAP_MAX_WAIT seconds, which is 0 (no waiting) unless set for threaded workers.
+    ?format=compact gives the seat map as {"rows": 2, "cols": 3, "active": [7, 7], "states": "ablaaa"},
+    one character of SEAT_STATE_CODES per seat in row major order, and the layout of the vehicle in
+    the compact form of the layouts view. The changes since a version then come as [index, code]
+    pairs into the states string ({"version": 7, "changes": [[1, "b"]]}).
     '''
     if request.method == "POST":
         try:
             request_json = json.loads(request.body.decode('utf-8'))
-            scheduled_vehicle = ScheduledVehicle.objects.create(
-                vehicle=Vehicle.objects.get(id=int(request_json['vehicle']))
-                )
-            schedule_objects = []
-            for schedule_json in request_json['schedule']:
-                route = Route.objects.get(id=int(schedule_json['route']))
-                try:
-                    schedule_objects.append(Schedule.objects.get(
-                        route=route,
-                        date=datetime_str_to_object(schedule_json['date']).date(),
-                        time=datetime_str_to_object(schedule_json['time']).time(),
-                        nature=str(schedule_json['nature'])
-                    ))
-                except Schedule.DoesNotExist:
-                    schedule_objects.append(Schedule.objects.create(
-                        route=route,
-                        date=datetime_str_to_object(schedule_json['date']).date(),
-                        time=datetime_str_to_object(schedule_json['time']).time(),
-                        nature=str(schedule_json['nature'])
-                    ))
-            scheduled_vehicle.schedule.set(schedule_objects)
-            scheduled_vehicle.save()
+            vehicle = Vehicle.objects.get(id=int(request_json['vehicle']))
+            entries = [schedule_json_to_entry(schedule_json) for schedule_json in request_json.get('schedule', [])]
+            for spec in request_json.get('recurrence', []):
+                entries.extend(expand_recurrence(spec))
+            with transaction.atomic():
+                scheduled_vehicle = ScheduledVehicle.objects.create(vehicle=vehicle)
+                scheduled_vehicle.schedule.add(*get_or_create_schedules(entries))
             return JsonResponse({'success': 'Successfully created the vehicle schedule'})
 
-        except (KeyError, json.decoder.JSONDecodeError, Route.DoesNotExist, Vehicle.DoesNotExist) as exp:
+        except (KeyError, TypeError, ValueError, json.decoder.JSONDecodeError, Route.DoesNotExist,
+                Vehicle.DoesNotExist, ScheduleRecurrenceException) as exp:
             return JsonResponse({'error': f'{exp.__class__.__name__}: {exp}'})
     response = []
+    # a trip that does not run on the schedule gets the full seat map path and its errors
+    if v_id and s_id and 'since' in request.GET and ScheduledVehicle.schedule.through.objects.filter(
+            scheduledvehicle_id=v_id, schedule_id=s_id).exists():
+        try:
+            since = int(request.GET['since'])
+            version = wait_for_change(v_id, s_id, since, float(request.GET.get('wait', 0)))
+            if version == since:
+                return HttpResponseNotModified()
+            if since < version <= since + settings.SEAT_CHANGE_VERSIONS:
+                changes = seat_changes(v_id, s_id, since, compact=wants_compact(request))
+                return JsonResponse({'version': version, 'changes': changes})
+            # a version from the future is stale and the changes after a very old one may be
+            # pruned, the full seat map follows
+        except ValueError as exp:
+            return JsonResponse({'error': f'{exp.__class__.__name__}: {exp}'})
     if v_id:
         try:
             response = {'scheduledVehicle':'', 'booked_seats':''}
             scheduled_vehicle_object = ScheduledVehicle.objects.get(id=v_id)
-            response['scheduledVehicle'] = (ScheduledVehicleSerializer(scheduled_vehicle_object).data)
+            context = {'compact': wants_compact(request)}
+            response['scheduledVehicle'] = (ScheduledVehicleSerializer(scheduled_vehicle_object, context=context).data)
             if s_id:
                 schedule_object = Schedule.objects.get(id=s_id)
-                booked_seats = get_seat_booking(scheduled_vehicle_object, schedule_object)
+                # read before the seats so that a change in between is sent again rather than missed
+                response['version'] = inventory_version(v_id, s_id)
+                booked_seats = get_seat_booking(scheduled_vehicle_object, schedule_object,
+                                                compact=context['compact'])
                 response['scheduledVehicle']['schedule'] = ScheduleSerializer(schedule_object).data
                 response['booked_seats'] = booked_seats
             return JsonResponse(response)
         except (KeyError, json.decoder.JSONDecodeError, ScheduledVehicle.DoesNotExist, Schedule.DoesNotExist) as exp:
             return JsonResponse({'error': f'{exp.__class__.__name__}: {exp}'})
     else:
-        sv_objects = ScheduledVehicle.objects.all()
-        for sv_object in sv_objects:
-            data = ScheduledVehicleSerializer(sv_object).data
-            data['vehicle']['vehicleType']['layout'] = None
-            response.append(data)
-        return JsonResponse({'scheduledVehicles': response})
+        fields = request.GET.get('fields')
+        serializer_kwargs = {'fields': fields.split(',')} if fields else {}
+        sv_objects = ScheduledVehicle.objects.select_related('vehicle__vehicle_type')
+        if 'schedule' in serializer_kwargs.get('fields', ['schedule']):
+            sv_objects = sv_objects.prefetch_related('schedule__route')
+        return list_response(request, 'scheduledVehicles', sv_objects,
+                             lambda sv_object: ScheduledVehicleSummarySerializer(sv_object, **serializer_kwargs).data)
+
+
+@require_http_methods(['POST'])
+@vary_on_headers('Accept')
+def seat_maps(request):
+    '''
+    View for getting the seat maps of many trips at once, in the compact format with ?format=compact
+    {
+        "trips": [{"trip": 1, "schedule": 3}, {"trip": 2, "schedule": 3}]
+    }
+    gives {"seatMaps": [{"trip": 1, "schedule": 3, "version": 4, "booked_seats": [...]}, ...]}
+    in the order asked, at most MAX_SEAT_MAPS at a time
+    '''
+    try:
+        request_json = json.loads(request.body.decode('utf-8'))
+        pairs = [(int(item['trip']), int(item['schedule'])) for item in request_json['trips']]
+        if len(pairs) > MAX_SEAT_MAPS:
+            return JsonResponse({'status':False,
+                                 'error':f"At most {MAX_SEAT_MAPS} seat maps can be asked for at once."})
+        return JsonResponse({'seatMaps': get_seat_bookings(pairs, compact=wants_compact(request))})
+    except (KeyError, TypeError, ValueError, json.decoder.JSONDecodeError) as exp:
+        return JsonResponse({'error': f'{exp.__class__.__name__}: {exp}'})
 
 
 def search(request):
     '''
-    View for handling search, takes in request and gives out list of SchudeledVehicles
+    View for handling search, takes in request and gives out list of SchudeledVehicles along
+    with their totalSeats and availableSeats
     {
         "route":1,
         "date":"2019-11-16T08:15:00.000"
@@ -231,14 +304,20 @@ def search(request):
         try:
             request_json = json.loads(request.body.decode('utf-8'))
             route = Route.objects.get(id=int(request_json['route']))
-            schedules = Schedule.objects.filter(date=datetime_str_to_object(request_json['date']).date(), route=route)
-            for schedule_object in schedules:
-                schedule_data = ScheduleSerializer(schedule_object).data
-                s_vehicles = schedule_object.scheduledvehicle_set.all()
-                for s_vehicle in s_vehicles:
-                    data = ScheduledVehicleSerializer(s_vehicle).data
-                    data['vehicle']['vehicleType']['layout'] = None
-                    data['schedule'] = schedule_data
+            schedules = Schedule.objects.filter(
+                date=datetime_str_to_object(request_json['date']).date(), route=route
+            ).select_related('route')
+            schedule_data = {schedule_object.id: ScheduleSerializer(schedule_object).data
+                             for schedule_object in schedules}
+            trips = {}
+            for trip in trips_with_availability(list(schedule_data)):
+                trips.setdefault(trip.schedule_id, []).append(trip)
+            for schedule_id, data_of_schedule in schedule_data.items():
+                for trip in trips.get(schedule_id, []):
+                    data = ScheduledVehicleSummarySerializer(trip.scheduledvehicle, fields=('id', 'vehicle')).data
+                    data['schedule'] = data_of_schedule
+                    data['totalSeats'] = trip.total_seats
+                    data['availableSeats'] = max(trip.total_seats - trip.booked_seats, 0)
                     response.append(data)
             return JsonResponse({'scheduledVehicles':response})
         except (KeyError, json.decoder.JSONDecodeError, Route.DoesNotExist, Schedule.DoesNotExist) as exp:
@@ -262,6 +341,8 @@ def book(request):
         "paymentMethod": "Khalti",
         "bookedOn":"2019-11-16T18:15:00.000"
     }
+    GET lists the upcoming bookings of the user a page at a time, pass the next cursor of
+    a page as ?cursor= to get the one after it, ?limit= sets the page size
     '''
     if request.method == "POST":
         try:
@@ -274,24 +355,45 @@ def book(request):
                 return JsonResponse({'status':False, 'error':"Intrusion Detected!"})
             if str(user.user_type) == "Agent":
                 pass # do something with the credits later
+            details = {
+                'passenger_name': str(request_json['passengerName']),
+                'passenger_phone': int(request_json['passengerPhone']),
+                'amount': int(request_json['amount']),
+                'is_paid': request_json['isPaid'],
+                'payment_method': str(request_json['paymentMethod']),
+                'booked_on': datetime_str_to_object(request_json['bookedOn'])
+            }
+            if get_inventory(trip.id, schedule_object.id).sold_out:
+                metrics.bookings_total.inc(result='sold_out')
+                return JsonResponse({'status':False, 'error':"This trip is sold out."})
             try:
-                booked = Booking.objects.get(trip=trip, seat=seat, schedule=schedule_object)
-                if booked:
+                with transaction.atomic():
+                    release_holds(expired_holds(trip=trip, schedule=schedule_object, seat=seat))
+                    booked = Booking.objects.select_for_update().filter(
+                        trip=trip, schedule=schedule_object, seat=seat, booked_by=user,
+                        state='locked', expires_on__gt=timezone.now()
+                    ).first()
+                    if booked:
+                        # the user is booking the seat they are holding
+                        for field, value in details.items():
+                            setattr(booked, field, value)
+                        booked.state = 'booked'
+                        booked.expires_on = None
+                        booked.save()
+                        adjust_inventory(trip.id, schedule_object.id, booked=1, locked=-1,
+                                         seats={seat.id: booked.state})
+                    else:
+                        booked = Booking.objects.create(trip=trip, schedule=schedule_object, seat=seat,
+                                                        booked_by=user, **details)
+                        adjust_inventory(trip.id, schedule_object.id, booked=1, seats={seat.id: booked.state})
+            except IntegrityError:
+                # the unique trip, schedule and seat constraint settles concurrent bookings
+                if Booking.objects.filter(trip=trip, seat=seat, schedule=schedule_object).exists():
+                    metrics.bookings_total.inc(result='conflict')
                     return JsonResponse({'status':False, 'error':"This Seat is already booked by someone else."})
-            except Booking.DoesNotExist:
-                booked = Booking.objects.create(trip=trip,
-                                                schedule=schedule_object,
-                                                seat=seat,
-                                                booked_by=user,
-                                                passenger_name=str(request_json['passengerName']),
-                                                passenger_phone=int(request_json['passengerPhone']),
-                                                amount=int(request_json['amount']),
-                                                is_paid=request_json['isPaid'],
-                                                payment_method=str(request_json['paymentMethod']),
-                                                booked_on=datetime_str_to_object(request_json['bookedOn'])
-                                                )
-                booked.save()
-                return JsonResponse({'bookedingId':int(booked.id)})
+                raise
+            metrics.bookings_total.inc(result='success')
+            return JsonResponse({'bookedingId':int(booked.id)})
         except (KeyError, json.decoder.JSONDecodeError, ScheduledVehicle.DoesNotExist, Seat.DoesNotExist) as exp:
             return JsonResponse({'error': f'{exp.__class__.__name__}: {exp}'})
 
@@ -299,10 +401,131 @@ def book(request):
     try:
         user = CustomUserBase.objects.get(id=request.user.id)
         last_day_date = datetime.datetime.now() - datetime.timedelta(days=1)
-        print(last_day_date)
-        bookings = Booking.objects.filter(booked_by=user).filter(Q(schedule__date__gte=last_day_date))
+        bookings = Booking.objects.filter(booked_by=user).filter(Q(schedule__date__gte=last_day_date)).select_related(
+            'trip__vehicle__vehicle_type', 'schedule__route', 'seat', 'booked_by'
+        )
+        bookings, next_cursor = paginate(bookings, request, ordering=('schedule__date', 'id'))
         for booking in bookings:
             response.append(booking_to_json(booking))
-    except (KeyError, CustomUserBase.DoesNotExist) as exp:
+    except (KeyError, CustomUserBase.DoesNotExist, PaginationException) as exp:
+        return JsonResponse({'error': f'{exp.__class__.__name__}: {exp}'})
+    return JsonResponse({'bookedSeats':response, 'next':next_cursor})
+
+
+@require_http_methods(['POST'])
+def book_bulk(request):
+    '''
+    View for booking several seats of a trip at once, either every seat gets booked or none
+    {
+        "trip":1,
+        "schedule":3,
+        "seats": ["A7", "A8", "B7"],
+        "bookedBy": "6e6a4570-71e1-40bb-a6f7-e5261aae2634",
+        "passengerName":"Some name",
+        "passengerPhone":984654131,
+        "amount":5000,
+        "isPaid":True,
+        "paymentMethod": "Khalti",
+        "bookedOn":"2019-11-16T18:15:00.000"
+    }
+    '''
+    try:
+        request_json = json.loads(request.body.decode('utf-8'))
+        trip = ScheduledVehicle.objects.select_related('vehicle__vehicle_type').get(id=int(request_json['trip']))
+        labels = [str(label) for label in request_json['seats']]
+        seats = list(Seat.objects.filter(layout_id=trip.vehicle.vehicle_type.layout_id, label__in=labels))
+        repeated = {label for label in labels if labels.count(label) > 1}
+        invalid = (set(labels) - {seat.label for seat in seats}) | repeated
+        if invalid or not labels:
+            return JsonResponse({'status':False, 'error':f"Invalid or repeated seats: {', '.join(sorted(invalid))}"})
+        schedule_object = Schedule.objects.get(id=int(request_json['schedule']))
+        user = CustomUserBase.objects.get(unique_id=str(request_json['bookedBy']))
+        if int(user.id) != int(request.user.id):
+            return JsonResponse({'status':False, 'error':"Intrusion Detected!"})
+        details = {
+            'passenger_name': str(request_json['passengerName']),
+            'passenger_phone': int(request_json['passengerPhone']),
+            'amount': int(request_json['amount']),
+            'is_paid': request_json['isPaid'],
+            'payment_method': str(request_json['paymentMethod']),
+            'booked_on': datetime_str_to_object(request_json['bookedOn'])
+        }
+        inventory = get_inventory(trip.id, schedule_object.id)
+        if inventory.unbooked < len(seats):
+            metrics.bookings_total.inc(result='sold_out')
+            return JsonResponse({'status':False, 'error':f"Only {inventory.unbooked} seats are left."})
+        trip_bookings = Booking.objects.filter(trip=trip, schedule=schedule_object, seat__in=seats)
+        # expired holds and the holds of the user on these seats are replaced by the bookings
+        replaced = Q(expires_on__lte=timezone.now()) | Q(booked_by=user)
+        taken = sorted(trip_bookings.exclude(replaced, state='locked', expires_on__isnull=False).values_list(
+            'seat__label', flat=True))
+        if taken:
+            metrics.bookings_total.inc(result='conflict')
+            return JsonResponse({'status':False, 'error':f"Seats already booked by someone else: {', '.join(taken)}"})
+        try:
+            with transaction.atomic():
+                release_holds(trip_bookings.filter(replaced, state='locked', expires_on__isnull=False))
+                bookings = Booking.objects.bulk_create([
+                    Booking(trip=trip, schedule=schedule_object, seat=seat, booked_by=user, **details)
+                    for seat in seats
+                ])
+                adjust_inventory(trip.id, schedule_object.id, booked=len(seats),
+                                 seats={booking.seat_id: booking.state for booking in bookings})
+        except IntegrityError:
+            if Booking.objects.filter(trip=trip, schedule=schedule_object, seat__in=seats).exists():
+                metrics.bookings_total.inc(result='conflict')
+                return JsonResponse({'status':False,
+                                     'error':"One or more of these seats are already booked by someone else."})
+            raise
+        metrics.bookings_total.inc(result='success')
+        booking_ids = dict(trip_bookings.values_list('seat__label', 'id'))
+        return JsonResponse({'bookingIds':[booking_ids[label] for label in labels]})
+    except (KeyError, TypeError, ValueError, json.decoder.JSONDecodeError, ScheduledVehicle.DoesNotExist,
+            Schedule.DoesNotExist, CustomUserBase.DoesNotExist) as exp:
+        return JsonResponse({'error': f'{exp.__class__.__name__}: {exp}'})
+
+
+@require_http_methods(['POST', 'DELETE'])
+def hold(request):
+    '''
+    View for holding a seat while the customer checks out, the seat is locked for
+    SEAT_HOLD_SECONDS and can then be booked by the same user through the book view.
+    {
+        "trip":1,
+        "schedule":3,
+        "seat": "A7",
+        "bookedBy": "6e6a4570-71e1-40bb-a6f7-e5261aae2634"
+    }
+    Send a DELETE with {"hold": 4} to release the hold.
+    '''
+    try:
+        request_json = json.loads(request.body.decode('utf-8'))
+        if request.method == "DELETE":
+            released = release_holds(Booking.objects.filter(id=int(request_json['hold']), booked_by=request.user.id,
+                                                            state='locked', expires_on__isnull=False))
+            if not released:
+                return JsonResponse({'status':False, 'error':"No such hold."})
+            return JsonResponse({'status':True})
+        trip = ScheduledVehicle.objects.get(id=int(request_json['trip']))
+        seat = Seat.objects.get(layout=trip.vehicle.vehicle_type.layout, label=str(request_json['seat']))
+        schedule_object = Schedule.objects.get(id=int(request_json['schedule']))
+        user = CustomUserBase.objects.get(unique_id=str(request_json['bookedBy']))
+        if int(user.id) != int(request.user.id):
+            return JsonResponse({'status':False, 'error':"Intrusion Detected!"})
+        now = timezone.now()
+        try:
+            with transaction.atomic():
+                release_holds(expired_holds(trip=trip, schedule=schedule_object, seat=seat))
+                held = Booking.objects.create(trip=trip, schedule=schedule_object, seat=seat, booked_by=user,
+                                              passenger_name='', passenger_phone=0, amount=0,
+                                              payment_method='', booked_on=now, state='locked',
+                                              expires_on=now + datetime.timedelta(seconds=settings.SEAT_HOLD_SECONDS))
+                adjust_inventory(trip.id, schedule_object.id, locked=1, seats={seat.id: held.state})
+        except IntegrityError:
+            if Booking.objects.filter(trip=trip, seat=seat, schedule=schedule_object).exists():
+                return JsonResponse({'status':False, 'error':"This Seat is already booked by someone else."})
+            raise
+        return JsonResponse({'holdId':int(held.id), 'expiresOn':held.expires_on.isoformat()})
+    except (KeyError, TypeError, ValueError, json.decoder.JSONDecodeError, ScheduledVehicle.DoesNotExist,
+            Seat.DoesNotExist, Schedule.DoesNotExist, CustomUserBase.DoesNotExist) as exp:
         return JsonResponse({'error': f'{exp.__class__.__name__}: {exp}'})
-    return JsonResponse({'bookedSeats':response})
@@ -0,0 +1,33 @@
+''' Gunicorn settings of yatri bus, hooks keeping the metrics shared through METRICS_DIR right '''
+import os
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'yatri_bus.settings')
+
+
+def metrics_registry():
+    ''' Returns the metrics registry when the metrics are shared through METRICS_DIR '''
+    if not os.environ.get('METRICS_DIR'):
+        return None
+    from yatri_bus import metrics
+    return metrics.registry
+
+
+def on_starting(server):
+    ''' Drops the samples left over by an earlier run, the counters start over with the server '''
+    registry = metrics_registry()
+    if registry:
+        registry.reset()
+
+
+def worker_exit(server, worker):
+    ''' Writes the samples a worker took since its last flush before it goes '''
+    registry = metrics_registry()
+    if registry:
+        registry.flush()
+
+
+def child_exit(server, worker):
+    ''' Folds the samples of a worker that exited, recycled or crashed, into the exited file '''
+    registry = metrics_registry()
+    if registry:
+        registry.fold(worker.pid)
@@ -0,0 +1,261 @@
+'''
+In-process metrics of yatri bus, exposed at /metrics in the Prometheus text format. Every
+process keeps its own samples and, when METRICS_DIR is set, writes them to a file of its own
+there at most every METRICS_FLUSH_SECONDS, and once more that long after its last sample. A
+scrape sums the files of every process, so the numbers cover all the gunicorn workers whichever
+one answers. The samples of exited workers are folded into one file by gunicorn.conf.py so that
+they are kept without piling up.
+'''
+import hmac
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from django.conf import settings
+from django.http import Http404, HttpResponse, HttpResponseForbidden
+
+try:
+    import fcntl
+except ImportError:
+    # no file locks, folding may be seen half done by a scrape
+    fcntl = None
+
+# upper bounds in seconds of the request latency buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def escape(value):
+    ''' Escapes a label value for the text format '''
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    ''' Formats a sample value, whole numbers without a fraction '''
+    if value == math.inf:
+        return '+Inf'
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Counter:
+    ''' Counter with labels, only ever goes up '''
+    kind = 'counter'
+
+    def __init__(self, registry, name, documentation, labelnames):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def labels(self, labels):
+        ''' Returns the label pairs of a sample in the order of labelnames '''
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} takes the labels {", ".join(self.labelnames)}')
+        return tuple((name, str(labels[name])) for name in self.labelnames)
+
+    def sample_names(self):
+        ''' Names of the samples of the metric '''
+        return {self.name}
+
+    def inc(self, amount=1, **labels):
+        ''' Adds amount to the counter of the labels '''
+        self.registry.add([(self.name, self.labels(labels), amount)])
+
+
+class Histogram(Counter):
+    ''' Histogram with labels and fixed buckets, counts observations at or below each bound '''
+    kind = 'histogram'
+
+    def __init__(self, registry, name, documentation, labelnames, buckets=LATENCY_BUCKETS):
+        super().__init__(registry, name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def sample_names(self):
+        ''' Names of the samples of the metric '''
+        return {f'{self.name}_bucket', f'{self.name}_sum', f'{self.name}_count'}
+
+    def observe(self, value, **labels):
+        ''' Records one observation of the labels '''
+        pairs = self.labels(labels)
+        samples = [(f'{self.name}_bucket', pairs + (('le', format_value(bound)),), 1)
+                   for bound in self.buckets if value <= bound]
+        samples.append((f'{self.name}_sum', pairs, value))
+        samples.append((f'{self.name}_count', pairs, 1))
+        self.registry.add(samples)
+
+
+class Registry:
+    '''
+    Holds the metrics and the samples of this process, keyed by sample name and label pairs.
+    directory is where the processes share their samples, None keeps them in the process.
+    '''
+    # file the samples of exited processes are folded into
+    exited = 'metrics-exited.json'
+
+    def __init__(self, directory=None, flush_seconds=1.0, process_id=None):
+        self.directory = directory
+        self.flush_seconds = flush_seconds
+        self.process_id = process_id
+        self.metrics = []
+        self.samples = {}
+        self.flushed_on = 0.0
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def counter(self, name, documentation, labelnames=()):
+        ''' Registers and returns a counter '''
+        self.metrics.append(Counter(self, name, documentation, labelnames))
+        return self.metrics[-1]
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        ''' Registers and returns a histogram '''
+        self.metrics.append(Histogram(self, name, documentation, labelnames, buckets))
+        return self.metrics[-1]
+
+    def add(self, samples):
+        '''
+        Adds the (sample name, label pairs, amount) samples, writing them out when due or else
+        making sure they are written once the flush interval is over
+        '''
+        with self._lock:
+            for name, pairs, amount in samples:
+                self.samples[(name, pairs)] = self.samples.get((name, pairs), 0) + amount
+            if not self.directory:
+                return
+            wait = self.flushed_on + self.flush_seconds - time.monotonic()
+            if wait <= 0:
+                self._flush()
+            elif self._timer is None or not self._timer.is_alive():
+                self._timer = threading.Timer(wait, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def path(self, process_id=None):
+        ''' File a process (this one by default) writes its samples to '''
+        return os.path.join(self.directory, f'metrics-{process_id or self.process_id or os.getpid()}.json')
+
+    def flush(self):
+        ''' Writes the samples of this process now '''
+        with self._lock:
+            if self.directory:
+                self._flush()
+
+    def _flush(self):
+        ''' Writes the samples of this process, replacing the file at once so readers never see half of it '''
+        os.makedirs(self.directory, exist_ok=True)
+        write_samples(self.path(), self.samples)
+        self.flushed_on = time.monotonic()
+
+    @contextmanager
+    def locked(self, shared):
+        ''' Holds the lock of the directory, shared by scrapes and exclusive while folding '''
+        if fcntl is None:
+            yield
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, '.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def fold(self, process_id):
+        '''
+        Adds the samples of an exited process to the exited file and deletes its own file, so
+        that its counts are kept while a new process reusing its id starts from zero
+        '''
+        with self.locked(shared=False):
+            samples = read_samples(self.path(process_id))
+            if samples is None:
+                return
+            exited = read_samples(os.path.join(self.directory, self.exited)) or {}
+            for key, value in samples.items():
+                exited[key] = exited.get(key, 0) + value
+            write_samples(os.path.join(self.directory, self.exited), exited)
+            os.remove(self.path(process_id))
+
+    def reset(self):
+        ''' Deletes the sample files of every process, left over by an earlier run '''
+        with self.locked(shared=False):
+            for file_name in os.listdir(self.directory):
+                if file_name.startswith('metrics-') and file_name.endswith('.json'):
+                    os.remove(os.path.join(self.directory, file_name))
+
+    def collect(self):
+        ''' Returns the samples of every process summed up '''
+        with self._lock:
+            if not self.directory:
+                return dict(self.samples)
+            self._flush()
+        totals = {}
+        with self.locked(shared=True):
+            for file_name in os.listdir(self.directory):
+                if not (file_name.startswith('metrics-') and file_name.endswith('.json')):
+                    continue
+                for key, value in (read_samples(os.path.join(self.directory, file_name)) or {}).items():
+                    totals[key] = totals.get(key, 0) + value
+        return totals
+
+    def exposition(self):
+        ''' Renders every metric in the Prometheus text format '''
+        samples = self.collect()
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            own = [key for key in samples if key[0] in metric.sample_names()]
+            for name, pairs in sorted(own, key=sample_order):
+                labels = ','.join(f'{label}="{escape(value)}"' for label, value in pairs)
+                lines.append(f'{name}{{{labels}}} {format_value(samples[(name, pairs)])}' if labels
+                             else f'{name} {format_value(samples[(name, pairs)])}')
+        return '\n'.join(lines) + '\n'
+
+
+def write_samples(path, samples):
+    ''' Writes the samples to the file, replacing it at once so readers never see half of it '''
+    temporary = f'{path}.tmp'
+    with open(temporary, 'w') as sample_file:
+        json.dump([[name, pairs, value] for (name, pairs), value in samples.items()], sample_file)
+    os.replace(temporary, path)
+
+
+def read_samples(path):
+    ''' Returns the samples of the file, None when it is gone '''
+    try:
+        with open(path) as sample_file:
+            samples = json.load(sample_file)
+    except (OSError, ValueError):
+        # gone or being replaced while listed
+        return None
+    return {(name, tuple(tuple(pair) for pair in pairs)): value for name, pairs, value in samples}
+
+
+def sample_order(key):
+    ''' Sorts samples by labels with the buckets of a histogram in the order of their bounds '''
+    name, pairs = key
+    labels = tuple(pair for pair in pairs if pair[0] != 'le')
+    bound = next((float(value) for label, value in pairs if label == 'le'), 0.0)
+    return labels, name, bound
+
+
+registry = Registry(getattr(settings, 'METRICS_DIR', None), getattr(settings, 'METRICS_FLUSH_SECONDS', 1.0))
+requests_total = registry.counter('yatri_http_requests_total', 'Requests served by url name and status code',
+                                  ('view', 'status'))
+request_duration = registry.histogram('yatri_http_request_duration_seconds',
+                                      'Time taken to serve a request by url name', ('view',))
+bookings_total = registry.counter('yatri_bookings_total', 'Booking attempts by result', ('result',))
+
+
+def metrics_view(request):
+    '''
+    View exposing the metrics of every process in the Prometheus text format to scrapers sending
+    METRICS_TOKEN as a bearer token, not found while no token is set
+    '''
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    if not token:
+        raise Http404('Metrics are turned off')
+    if not hmac.compare_digest(request.META.get('HTTP_AUTHORIZATION', ''), f'Bearer {token}'):
+        return HttpResponseForbidden()
+    return HttpResponse(registry.exposition(), content_type='text/plain; version=0.0.4; charset=utf-8')
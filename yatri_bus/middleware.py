@@ -0,0 +1,194 @@
+''' Middleware of yatri bus '''
+import cProfile
+import json
+import logging
+import os
+import random
+import re
+import time
+from collections import Counter
+from contextlib import ExitStack
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.utils import timezone
+from . import metrics, routers
+
+logger = logging.getLogger('yatri_bus.sql')
+
+# runs of placeholders in IN lists, collapsed so that lists of any length share a shape
+PLACEHOLDER_RUN = re.compile(r'%s(?:, %s)+')
+
+
+def query_shape(sql):
+    ''' Returns the template of the query with IN lists of any length made the same '''
+    return PLACEHOLDER_RUN.sub('%s, ...', sql)
+
+
+class QueryRecorder:
+    ''' Execute wrapper that times every query and counts the queries of each shape '''
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.shapes = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - start
+            self.count += 1
+            self.shapes[query_shape(sql)] += 1
+
+
+class SQLInstrumentationMiddleware:
+    '''
+    Records the number and total time of the SQL queries of every request along with the
+    time taken by the view, sends them back in a Server-Timing header and logs them as a
+    json line on the yatri_bus.sql logger. A warning names the view when one query shape
+    runs more than SQL_REPEAT_THRESHOLD times, the usual sign of an N+1. Turned on with
+    SQL_INSTRUMENTATION. Queries run while a streaming response is consumed are not counted.
+    '''
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'SQL_INSTRUMENTATION', False):
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        self.threshold = getattr(settings, 'SQL_REPEAT_THRESHOLD', 5)
+
+    def __call__(self, request):
+        recorder = QueryRecorder()
+        start = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(recorder))
+            response = self.get_response(request)
+        view_ms = (time.perf_counter() - start) * 1000
+        sql_ms = recorder.duration * 1000
+        match = getattr(request, 'resolver_match', None)
+        view = f'{match.func.__module__}.{match.func.__name__}' if match else request.path
+        repeated = {shape: count for shape, count in recorder.shapes.items() if count > self.threshold}
+        response['Server-Timing'] = (f'sql;dur={sql_ms:.1f};desc="{recorder.count} queries", '
+                                     f'view;dur={view_ms:.1f}')
+        logger.info(json.dumps({'method': request.method, 'path': request.path, 'view': view,
+                                'status': response.status_code, 'queries': recorder.count,
+                                'sql_ms': round(sql_ms, 1), 'view_ms': round(view_ms, 1),
+                                'repeated': len(repeated)}))
+        for shape, count in repeated.items():
+            logger.warning('%s ran the same query %d times: %s', view, count, shape)
+        return response
+
+
+class MetricsMiddleware:
+    ''' Counts every request and times it by url name and status code, turned off with METRICS_ENABLED '''
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'METRICS_ENABLED', True):
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        start = time.perf_counter()
+        response = self.get_response(request)
+        match = getattr(request, 'resolver_match', None)
+        view = match.url_name if match and match.url_name else 'unmatched'
+        metrics.request_duration.observe(time.perf_counter() - start, view=view)
+        metrics.requests_total.inc(view=view, status=response.status_code)
+        return response
+
+
+def profile_name(view, elapsed_ms):
+    ''' File name of a request profile, sorting by the time it was taken '''
+    view = re.sub(r'[^\w]', '_', view)
+    return f'{timezone.now():%Y%m%d%H%M%S%f}-{os.getpid()}-{view}-{elapsed_ms:.0f}ms.prof'
+
+
+class ProfilingMiddleware:
+    '''
+    Runs cProfile over a sampled share (PROFILE_SAMPLE_RATE) of the requests, and over every
+    request sent with an X-Profile: 1 header when PROFILE_ALLOW_HEADER is set, writing each
+    profile to PROFILE_DIR named after its url name and timing. Only the newest PROFILE_KEEP
+    profiles are kept. Turned off while PROFILE_DIR is unset or nothing can be sampled.
+    '''
+
+    def __init__(self, get_response):
+        self.directory = getattr(settings, 'PROFILE_DIR', None)
+        self.sample_rate = getattr(settings, 'PROFILE_SAMPLE_RATE', 0)
+        self.allow_header = getattr(settings, 'PROFILE_ALLOW_HEADER', False)
+        if not self.directory or not (self.sample_rate > 0 or self.allow_header):
+            raise MiddlewareNotUsed()
+        self.keep = getattr(settings, 'PROFILE_KEEP', 200)
+        self.get_response = get_response
+
+    def __call__(self, request):
+        asked = self.allow_header and request.META.get('HTTP_X_PROFILE') == '1'
+        if not asked and random.random() >= self.sample_rate:
+            return self.get_response(request)
+        profiler = cProfile.Profile()
+        start = time.perf_counter()
+        try:
+            profiler.enable()
+        except ValueError:
+            # another profiler is running in this thread
+            return self.get_response(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            profiler.disable()
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        match = getattr(request, 'resolver_match', None)
+        name = profile_name(match.url_name if match and match.url_name else 'unmatched', elapsed_ms)
+        os.makedirs(self.directory, exist_ok=True)
+        profiler.dump_stats(os.path.join(self.directory, name))
+        self.rotate()
+        if asked:
+            response['X-Profile'] = name
+        return response
+
+    def rotate(self):
+        ''' Deletes the oldest profiles beyond PROFILE_KEEP '''
+        profiles = sorted(name for name in os.listdir(self.directory) if name.endswith('.prof'))
+        for name in profiles[:max(len(profiles) - self.keep, 0)]:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                # rotated away by another worker
+                pass
+
+
+class ReplicaRoutingMiddleware:
+    '''
+    Lets the url names and methods listed in REPLICA_VIEWS read from the replica database. A
+    request that writes gets a cookie keeping the reads of that client on the primary for
+    REPLICA_STICKY_SECONDS, long enough for the replica to catch up with the write. Clients
+    that drop the cookie may read stale rows, so only views that can lag belong in the list.
+    Turned off while REPLICA_DATABASE is unset. Streaming bodies are read from the primary.
+    '''
+    cookie = 'yatri_primary_until'
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'REPLICA_DATABASE', None):
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        routers.begin_request()
+        try:
+            response = self.get_response(request)
+            if routers.has_written():
+                until = time.time() + settings.REPLICA_STICKY_SECONDS
+                response.set_cookie(self.cookie, f'{until:.0f}', max_age=settings.REPLICA_STICKY_SECONDS,
+                                    httponly=True)
+        finally:
+            routers.begin_request()
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        methods = settings.REPLICA_VIEWS.get(request.resolver_match.url_name, ())
+        try:
+            sticky = float(request.COOKIES.get(self.cookie, 0)) > time.time()
+        except ValueError:
+            sticky = False
+        routers.allow_replica(request.method in methods and not sticky)
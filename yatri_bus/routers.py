@@ -0,0 +1,47 @@
+''' Database routers of yatri bus '''
+import threading
+from django.conf import settings
+
+# routing state of the request the thread is serving, kept by ReplicaRoutingMiddleware
+_state = threading.local()
+
+
+def begin_request():
+    ''' Starts a request on the primary with nothing written yet '''
+    _state.replica = False
+    _state.wrote = False
+
+
+def allow_replica(allowed):
+    ''' Lets the reads of the current request go to the replica, or keeps them on the primary '''
+    _state.replica = allowed
+
+
+def has_written():
+    ''' Tells whether the current request has asked for a database to write to '''
+    return getattr(_state, 'wrote', False)
+
+
+class ReplicaRouter:
+    '''
+    Sends the reads of REPLICA_APPS models to the REPLICA_DATABASE alias while the request is
+    allowed to use the replica and has not written anything yet, so that a request always
+    reads its own writes. Writes and every other read go to the primary.
+    '''
+
+    def db_for_read(self, model, **hints):
+        if (settings.REPLICA_DATABASE and getattr(_state, 'replica', False) and not has_written()
+                and model._meta.app_label in settings.REPLICA_APPS):
+            return settings.REPLICA_DATABASE
+        return None
+
+    def db_for_write(self, model, **hints):
+        _state.wrote = True
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        ''' Rows read from the replica are rows of the primary '''
+        aliases = {'default', settings.REPLICA_DATABASE}
+        if obj1._state.db in aliases and obj2._state.db in aliases:
+            return True
+        return None
@@ -49,6 +49,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'yatri_bus.middleware.MetricsMiddleware',
+    'yatri_bus.middleware.SQLInstrumentationMiddleware',
+    'yatri_bus.middleware.ProfilingMiddleware',
+    'yatri_bus.middleware.ReplicaRoutingMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -140,4 +144,65 @@ STATICFILES_DIRS = (
 STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 django_heroku.settings(locals())
 
+# django_heroku only configures testlogger, the info lines of yatri_bus (the per request SQL log)
+# would be dropped without a handler of their own
+LOGGING['loggers']['yatri_bus'] = {
+    'handlers': ['console'],
+    'level': 'INFO',
+    'propagate': False,
+}
+
 AUTH_USER_MODEL = 'users.CustomUserBase'
+
+# Seconds a seat stays locked by a hold before it can be booked by someone else
+SEAT_HOLD_SECONDS = 600
+
+# Longest a seat map request with ?wait= is held open for a change, and how often it checks. A
+# waiting request keeps a worker and a database connection busy, so long polling stays off (0)
+# unless gunicorn runs threaded or async workers (--threads, -k gevent) with room to spare.
+SEAT_MAP_MAX_WAIT = float(os.environ.get('SEAT_MAP_MAX_WAIT', 0))
+SEAT_MAP_POLL_SECONDS = 1
+# Versions of seat changes kept per trip for ?since, the expired holds sweeper prunes older ones
+# and clients further behind get the full seat map
+SEAT_CHANGE_VERSIONS = 500
+
+# Per request SQL counts and timings in a Server-Timing header and the yatri_bus.sql log, with a
+# warning when one query runs more than SQL_REPEAT_THRESHOLD times in a request
+SQL_INSTRUMENTATION = os.environ.get('SQL_INSTRUMENTATION') == '1'
+SQL_REPEAT_THRESHOLD = 5
+
+# Request and booking metrics served at /metrics, the processes share them through files in
+# METRICS_DIR. The hooks in gunicorn.conf.py empty it on start and keep the counts of exited workers.
+# Scrapers send METRICS_TOKEN as a bearer token, /metrics is not found while it is unset.
+METRICS_ENABLED = True
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+METRICS_DIR = os.environ.get('METRICS_DIR')
+METRICS_FLUSH_SECONDS = 1.0
+
+# cProfile of a sampled share of the requests written to PROFILE_DIR, PROFILE_ALLOW_HEADER also
+# profiles every request sent with X-Profile: 1. Read them with the profile_report command.
+PROFILE_DIR = os.environ.get('PROFILE_DIR')
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+PROFILE_ALLOW_HEADER = os.environ.get('PROFILE_ALLOW_HEADER') == '1'
+PROFILE_KEEP = 200
+
+# Read only views read from the REPLICA_DATABASE alias, configured with REPLICA_DATABASE_URL (a
+# second sqlite file works locally). Clients that wrote read from the primary for a while, as
+# long as they keep the cookie. Seat maps, their versions and the booking history of a user are
+# always read from the primary, a lagging replica would hide bookings and hand out old versions.
+DATABASE_ROUTERS = ['yatri_bus.routers.ReplicaRouter']
+REPLICA_DATABASE = None
+if os.environ.get('REPLICA_DATABASE_URL'):
+    DATABASES['replica'] = dj_database_url.parse(os.environ['REPLICA_DATABASE_URL'], conn_max_age=600)
+    REPLICA_DATABASE = 'replica'
+REPLICA_APPS = ('apiv1',)
+REPLICA_STICKY_SECONDS = 10
+REPLICA_VIEWS = {
+    'layouts': ('GET', 'HEAD'),
+    'routes': ('GET', 'HEAD'),
+    'vehicle_types': ('GET', 'HEAD'),
+    'vehicles': ('GET', 'HEAD'),
+    'schedule': ('GET', 'HEAD'),
+    'vehicle_items': ('GET', 'HEAD'),
+    'Search': ('POST',),
+}
@@ -1,9 +1,11 @@
 ''' Module containing the url patterns of yatri bus '''
 from django.contrib import admin
 from django.urls import path, include
+from .metrics import metrics_view
 
 urlpatterns = [
     path('doc/', include('django.contrib.admindocs.urls')),
+    path('metrics', metrics_view, name='metrics'),
     path('', admin.site.urls),
     path('api/v1/', include('apiv1.urls')),
 ]